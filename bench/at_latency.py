@@ -0,0 +1,54 @@
+import os
+import sys
+import json
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench.modem_sim import FakeModem
+from src.sim7080g import SIM7080G
+from src.session import HTTPSSession
+
+# 応答を待たずに固定時間sleepする従来の動作
+class LegacySIM7080G(SIM7080G):
+    def read_response(self, command, back, timeout=1.0, urc=False, payload=0):
+        self.time.sleep(timeout)
+        return self.reader.wait(lambda buffer: False, 0.1)
+
+def run(cls, requests):
+    sim7080g = cls(modem=FakeModem())
+    body = json.dumps({"body": json.dumps({"table": "device", "action": "update"})})
+    start = time.perf_counter()
+    for i in range(requests):
+        response = sim7080g.https_post(
+            url="http://funk.soracom.io",
+            headers={"Content-Type": "application/json"},
+            body=body
+        )
+        if response.get("code") != 200:
+            print(f"{cls.__name__}: request {i} failed")
+    return (time.perf_counter() - start) / requests
+
+def run_session(requests):
+    modem = FakeModem()
+    session = HTTPSSession(SIM7080G(modem=modem), "http://funk.soracom.io", {"Content-Type": "application/json"})
+    body = json.dumps({"body": json.dumps({"table": "device", "action": "update"})})
+    start = time.perf_counter()
+    for i in range(requests):
+        response = session.post(body)
+        if response.get("code") != 200:
+            print(f"HTTPSSession: request {i} failed")
+    return (time.perf_counter() - start) / requests, modem.written / requests
+
+def main():
+    requests = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+    legacy = run(LegacySIM7080G, requests)
+    event = run(SIM7080G, requests)
+    print(f"legacy: {legacy:.3f} s/request")
+    print(f"event:  {event:.3f} s/request")
+    print(f"saving: {legacy - event:.3f} s/request ({legacy / event:.1f}x)")
+    session, written = run_session(requests)
+    print(f"session: {session:.3f} s/request, {written:.0f} bytes/request to modem")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+import socket
+import socketserver
+import threading
+import time
+import random
+
+class FakePLCHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        server = self.server
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        time.sleep(server.accept_latency)
+        buffer = b''
+        while True:
+            try:
+                data = self.request.recv(1024)
+            except OSError:
+                return
+            if not data:
+                return
+            buffer += data
+            while b'\r' in buffer:
+                line, buffer = buffer.split(b'\r', 1)
+                line = line.strip()
+                if not line:
+                    continue
+                server.commands += 1
+                time.sleep(server.latency)
+                self.request.sendall((server.respond(line.decode("ascii")) + "\r\n").encode("ascii"))
+
+class FakePLC(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, host="127.0.0.1", port=0, latency=0.002, accept_latency=0.01, noise=0):
+        super().__init__((host, port), FakePLCHandler)
+        self.latency = latency
+        self.accept_latency = accept_latency
+        # 読み出すたびに0からnoiseまでの値を加える (不感帯を通過させるため)
+        self.noise = noise
+        self.registers = {}
+        self.commands = 0
+        self.thread = None
+
+    def value(self, device):
+        prefix = device.rstrip("0123456789")
+        address = int(device[len(prefix):])
+        value = self.registers.get(device, address % 65536)
+        if self.noise:
+            value = (value + random.randint(0, self.noise)) % 65536
+        return value, prefix, address
+
+    # データ形式 (.U/.S/.D/.L/.H) に合わせて1ワードまたは2ワード (下位ワードが先) を整形する
+    def format(self, prefix, address, suffix):
+        if suffix in ("D", "L"):
+            value = self.value(f"{prefix}{address}")[0] | self.value(f"{prefix}{address + 1}")[0] << 16
+            if suffix == "L":
+                return f"{value - (1 << 32) if value >= 1 << 31 else value:+011d}"
+            return f"{value:010d}"
+        value = self.value(f"{prefix}{address}")[0]
+        if suffix == "S":
+            return f"{value - 65536 if value >= 32768 else value:+06d}"
+        if suffix == "H":
+            return f"{value:04X}"
+        return f"{value:05d}"
+
+    def respond(self, line):
+        parts = line.split()
+        command = parts[0].upper()
+        if command in ("RD", "RDS", "RDE") and len(parts) >= 2:
+            count = int(parts[2]) if command != "RD" and len(parts) >= 3 else 1
+            device, _, suffix = parts[1].partition(".")
+            _, prefix, address = self.value(device)
+            words = 2 if suffix in ("D", "L") else 1
+            return " ".join(self.format(prefix, address + i * words, suffix) for i in range(count))
+        if command in ("WR", "WRS", "ST", "RS"):
+            return "OK"
+        return "E1"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self.server_address
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
@@ -0,0 +1,177 @@
+import time
+import random
+import threading
+
+class FakeModem:
+    def __init__(self, latency=None, body=b'{"status":200}', echo=True, timeout=0.01, loss=0.0, seed=None, cold=False):
+        self.latency = {
+            "AT": 0.005,
+            "AT+SHCONN": 1.2,
+            "AT+SHREQ": 0.8,
+            "AT+SHREAD": 0.05,
+            "AT+SHBOD": 0.01,
+            "AT+CNACT": 0.5,
+            "AT+CFUN": 0.5,
+            # AT+CFUN=1から網に登録されるまで
+            "attach": 8.0
+        }
+        if latency:
+            self.latency.update(latency)
+        # bodyは固定の応答か、送信されたボディから応答を返す関数
+        self.body = body
+        self.request = b''
+        self.response = b''
+        self.status = 200
+        self.echo = echo
+        self.timeout = timeout
+        self.buffer = b''
+        self.pending = []
+        # SIM7080Gは書き込みと読み出しを別のスレッドから行う
+        self.lock = threading.RLock()
+        self.connected = False
+        # coldは電源投入直後 (工場出荷時の設定で未接続)
+        self.settings = {"CNMP": "2", "CMNB": "3"} if cold else {"CNMP": "38", "CMNB": "1"}
+        self.attached = not cold
+        self.pdp = not cold
+        self.attach_at = 0
+        # CFUNでしか復旧しない障害
+        self.stuck = False
+        self.bodylen = 0
+        self.written = 0
+        self.loss = loss
+        self.lost = 0
+        self.random = random.Random(seed)
+
+    def delay(self, command):
+        for key in sorted(self.latency, key=len, reverse=True):
+            if command.startswith(key):
+                return self.latency[key]
+        return self.latency["AT"]
+
+    def queue(self, delay, data):
+        with self.lock:
+            self.pending.append((time.monotonic() + delay, data.encode() if isinstance(data, str) else data))
+            self.pending.sort(key=lambda item: item[0])
+
+    # 指定した段階の障害を起こす (sh, pdp, register, cfun)
+    def drop(self, level):
+        self.connected = False
+        if level == "sh":
+            self.queue(0, "\r\n+SHSTATE: 0\r\n")
+            return
+        self.pdp = False
+        self.queue(0, "\r\n+APP PDP: 0,DEACTIVE\r\n")
+        if level in ("register", "cfun"):
+            self.attached = False
+        if level == "cfun":
+            self.stuck = True
+
+    def is_attached(self):
+        return self.attached and time.monotonic() >= self.attach_at
+
+    def respond(self, command):
+        delay = self.delay(command)
+        # lossの確率で応答を返さない
+        if self.loss and self.random.random() < self.loss:
+            self.lost += 1
+            return
+        if command.startswith("AT+SHREQ"):
+            if not self.connected:
+                self.queue(delay, "ERROR\r\n")
+                return
+            self.response = self.body(self.request) if callable(self.body) else self.body
+            self.request = b''
+            self.queue(0.005, "OK\r\n")
+            self.queue(delay, f'\r\n+SHREQ: "POST",{self.status},{len(self.response)}\r\n')
+        elif command.startswith("AT+SHREAD"):
+            offset, length = [int(value) for value in command.split("=")[1].split(",")]
+            data = self.response[offset:offset + length]
+            self.queue(delay, f"OK\r\n\r\n+SHREAD: {len(data)}\r\n".encode() + data + b"\r\n")
+        elif command.startswith("AT+SHBOD"):
+            self.bodylen = int(command.split("=")[1].split(",")[0])
+            self.queue(delay, "> ")
+        elif command.startswith("AT+SHCONN"):
+            self.connected = self.pdp
+            self.queue(delay, "OK\r\n" if self.pdp else "ERROR\r\n")
+        elif command.startswith("AT+SHDISC"):
+            self.connected = False
+            self.queue(delay, "OK\r\n")
+        elif command.startswith("AT+SHSTATE?"):
+            self.queue(delay, f"+SHSTATE: {int(self.connected)}\r\n\r\nOK\r\n")
+        elif command.startswith("AT+CGATT?"):
+            self.queue(delay, f"+CGATT: {int(self.is_attached())}\r\n\r\nOK\r\n")
+        elif command.startswith("AT+CGATT="):
+            self.attached = command.endswith("1") and not self.stuck
+            self.queue(delay, "OK\r\n")
+        elif command.startswith(("AT+CNMP", "AT+CMNB")):
+            name = command[3:7]
+            if command.endswith("?"):
+                self.queue(delay, f"+{name}: {self.settings[name]}\r\n\r\nOK\r\n")
+            else:
+                self.settings[name] = command.split("=")[1]
+                self.queue(delay, "OK\r\n")
+        elif command.startswith("AT+CFUN="):
+            self.attached = command.endswith("1")
+            self.attach_at = time.monotonic() + self.latency["attach"]
+            self.pdp = False
+            self.connected = False
+            self.stuck = False
+            self.queue(delay, "OK\r\n")
+        elif command.startswith("AT+CNACT?"):
+            self.queue(delay, f'+CNACT: 0,{int(self.pdp)},"10.0.0.1"\r\n\r\nOK\r\n')
+        elif command.startswith("AT+CNACT=0,0"):
+            self.pdp = False
+            self.connected = False
+            self.queue(delay, "OK\r\n\r\n+APP PDP: 0,DEACTIVE\r\n")
+        elif command.startswith("AT+CSQ"):
+            self.queue(delay, "+CSQ: 20,99\r\n\r\nOK\r\n")
+        elif command.startswith("AT+CPSI?"):
+            system = "LTE CAT-M1,Online" if self.is_attached() else "NO SERVICE,Online"
+            self.queue(delay, f"+CPSI: {system}\r\n\r\nOK\r\n")
+        elif command.startswith("AT+CPIN?"):
+            self.queue(delay, "+CPIN: READY\r\n\r\nOK\r\n")
+        elif command.startswith("AT+CNACT=0,1"):
+            if not self.is_attached():
+                self.queue(delay, "ERROR\r\n")
+                return
+            self.pdp = True
+            self.queue(0.005, "OK\r\n")
+            self.queue(delay, "\r\n+APP PDP: 0,ACTIVE\r\n")
+        else:
+            self.queue(delay, "OK\r\n")
+
+    def write(self, data):
+        self.written += len(data)
+        if self.bodylen:
+            self.bodylen = 0
+            self.request = data.rstrip(b'\r\n')
+            self.queue(self.latency["AT"], "OK\r\n")
+            return len(data)
+        command = data.decode(errors="ignore").strip()
+        if self.echo:
+            self.queue(0, command + "\r\r\n")
+        self.respond(command)
+        return len(data)
+
+    def release(self):
+        now = time.monotonic()
+        with self.lock:
+            while self.pending and self.pending[0][0] <= now:
+                self.buffer += self.pending.pop(0)[1]
+
+    def inWaiting(self):
+        self.release()
+        return len(self.buffer)
+
+    def read(self, size=1):
+        deadline = time.monotonic() + self.timeout
+        while not self.inWaiting() and time.monotonic() < deadline:
+            time.sleep(0.001)
+        with self.lock:
+            data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def flushInput(self):
+        self.release()
+        with self.lock:
+            self.buffer = b''
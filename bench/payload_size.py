@@ -0,0 +1,42 @@
+import os
+import sys
+import random
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.encoder import get_encoder
+
+def make_rows(count):
+    rows = []
+    value = 50.0
+    for i in range(count):
+        value = round(value + random.uniform(-0.5, 0.5), 2)
+        rows.append({
+            "sensorId": f"sensor-{i % 13:02d}",
+            "value": value,
+            "plantId": "plant-0001",
+            "count": 42
+        })
+    return rows
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    random.seed(0)
+    params = {
+        "table": "measure",
+        "action": "insert",
+        "data": make_rows(count)
+    }
+
+    baseline = None
+    for name in ("nested", "flat", "columnar", "nested+deflate", "flat+deflate", "columnar+deflate"):
+        encoder = get_encoder(name)
+        for _ in range(100):
+            encoder.encode(params)
+        size = encoder.stats["bytes"] / encoder.stats["count"]
+        elapsed = encoder.stats["time"] / encoder.stats["count"] * 1000
+        baseline = baseline or size
+        print(f"{name:18s} {size:7.0f} bytes  {size / count:6.1f} bytes/measure  {elapsed:6.3f} ms  ({1 - size / baseline:.0%} saved)")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,217 @@
+import os
+import re
+import sys
+import json
+import asyncio
+import argparse
+import tempfile
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench.modem_sim import FakeModem
+from bench.fake_plc import FakePLC
+from src.sim7080g import SIM7080G
+from src.session import HTTPSSession
+from src.batch import MeasureBatch
+from src.measure_queue import MeasureQueue
+from src.state_store import StateStore
+from src.encoder import get_encoder
+from src.action_sync import ActionSync
+from src.scheduler import SamplingScheduler
+from src.filter import DeadbandFilter
+from src.runtime import AsyncSIM7080G, Runtime
+from src.devices import DeviceRegistry, PLCFanOut
+from src.link_supervisor import LinkSupervisor
+from src.metrics import metrics
+
+# PLCごとにcmd_mapの全レジスタをセンサーとして登録するactionテーブル
+def build_actions(plcs, cmd_map):
+    actions = []
+    for name in plcs:
+        for register, command in cmd_map.items():
+            actions.append({
+                "count": len(actions) + 1,
+                "deviceId": "bench",
+                "sensorId": f"{name}:{register}",
+                "command": f"{command} 1"
+            })
+    return actions
+
+# actionテーブルはcountのカーソルより新しい行を返し、それ以外は空の応答を返す
+def build_responder(actions):
+    def respond(request):
+        try:
+            params = json.loads(request)
+            if "body" in params:
+                params = json.loads(params["body"])
+        except ValueError:
+            return b'{}'
+        if params.get("table") != "action":
+            return b'{}'
+        query = params.get("query", "")
+        cursor = int(re.search(r"count=gt\.(\d+)", query).group(1))
+        limit = int(re.search(r"limit=(\d+)", query).group(1))
+        rows = [action for action in actions if action["count"] > cursor][:limit]
+        return json.dumps({"data": rows}).encode()
+    return respond
+
+def build_modem(args, responder):
+    options = {
+        "body": responder,
+        "loss": args.loss,
+        "seed": args.seed,
+        "cold": args.cold,
+        "latency": {key: value * args.latency_scale for key, value in FakeModem().latency.items()}
+    }
+    if args.pty:
+        from bench.pty_modem import PtyModem
+        pty = PtyModem(**options)
+        return pty.modem, SIM7080G(port=pty.start()), pty
+    modem = FakeModem(**options)
+    return modem, SIM7080G(modem=modem), None
+
+async def run_runtime(runtime, duration, fake=None, outage=None, outage_at=None):
+    loop = asyncio.get_running_loop()
+    loop.call_later(duration, runtime.stop)
+    if outage:
+        # 途中で回線の障害を起こし、復旧までの時間を計測する
+        loop.call_later(outage_at if outage_at is not None else duration / 3, fake.drop, outage)
+    await runtime.run()
+
+# fakeとworkdirを渡すと、モデムと保存済みの状態を引き継いで再起動する
+def run(args, fake=None, workdir=None):
+    metrics.reset()
+    workdir = workdir or tempfile.mkdtemp(prefix="plantiot-bench-")
+    servers = {f"plc{i}": FakePLC(latency=args.plc_latency, noise=args.noise) for i in range(args.plcs)}
+    plcs = {}
+    for name, server in servers.items():
+        host, port = server.start()
+        plcs[name] = {"host": host, "port": port}
+
+    registry = DeviceRegistry(plcs)
+    plc_fanout = PLCFanOut(registry)
+    actions = build_actions(plcs, plc_fanout.cmd_map)
+    registry.routes = {"sensorId": {action["sensorId"]: action["sensorId"].split(":")[0] for action in actions}}
+
+    pty = None
+    if fake is None:
+        fake, sim7080g, pty = build_modem(args, build_responder(actions))
+    else:
+        sim7080g = SIM7080G(modem=fake)
+    sim7080g.set_apn("soracom.io")
+
+    state = StateStore(os.path.join(workdir, "state.json"))
+    if state.get("count") is None:
+        # 全てのactionを未実行として取得させる (カーソルが無いと最新のcountしか実行しない)
+        state.set("count", 0)
+    session = HTTPSSession(sim7080g, "http://funk.soracom.io", {"Content-Type": "application/json"})
+    link = LinkSupervisor(sim7080g, session, state=state)
+    encoder = get_encoder(args.encoding)
+    runtime = Runtime(
+        modem=AsyncSIM7080G(session),
+        plcs=plc_fanout,
+        scheduler=SamplingScheduler(plc_fanout.cmd_map, {}, args.sampling_interval, 0, registry),
+        batch=MeasureBatch(args.batch_size, 0, session.bodylen, encoder),
+        queue=MeasureQueue(os.path.join(workdir, "measure.db")),
+        state=state,
+        sync=ActionSync(state, "bench", limit=len(actions), min_interval=args.polling_interval, max_interval=args.polling_interval),
+        device_id="bench",
+        polling_interval=args.polling_interval,
+        sampling_interval=args.sampling_interval,
+        encoder=encoder,
+        filter=DeadbandFilter({}, {"absolute": args.deadband}),
+        metrics_interval=args.duration * 2,
+        link=link
+    )
+    asyncio.run(run_runtime(runtime, args.duration, fake, args.outage, args.outage_at))
+
+    for server in servers.values():
+        server.stop()
+    if pty:
+        pty.stop()
+
+    snapshot = metrics.snapshot()
+    counters = snapshot["counters"]
+    latency = snapshot["latency"]
+    cycles = latency.get("cycle.sample", {}).get("count", 0)
+    result = {
+        "bring_up": latency.get("link.bring_up", {}).get("max", 0),
+        "first_sample": latency.get("runtime.first_sample", {}).get("max", 0),
+        "cycles_per_minute": round(cycles * 60 / args.duration, 1),
+        "sampled": counters.get("measure.sampled", 0),
+        "uploaded": counters.get("measure.uploaded", 0),
+        "latency_p50": latency.get("measure.latency", {}).get("p50", 0),
+        "latency_p95": latency.get("measure.latency", {}).get("p95", 0),
+        "http_bytes": counters.get("http.tx_bytes", 0) + counters.get("http.rx_bytes", 0),
+        "serial_bytes": counters.get("modem.tx_bytes", 0) + counters.get("modem.rx_bytes", 0),
+        "lost": fake.lost,
+        "upload_retries": counters.get("upload.retry", 0),
+        "outage_max": latency.get("link.outage", {}).get("max", 0),
+        "recoveries": sum(link.recoveries.values())
+    }
+    return result, fake, workdir
+
+# 基準値より悪化した項目を返す (latencyとbytesは増加、cyclesは減少を悪化とする)
+def compare(result, baseline, tolerance):
+    regressions = []
+    for key, value in baseline.items():
+        if key not in result or not value:
+            continue
+        if key == "cycles_per_minute":
+            worse = result[key] < value * (1 - tolerance)
+        elif key.startswith(("latency", "outage", "bring_up", "first_sample")) or key.endswith("bytes"):
+            worse = result[key] > value * (1 + tolerance)
+        else:
+            continue
+        if worse:
+            regressions.append(f"{key}: {value} -> {result[key]}")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmark of the sampling/upload pipeline")
+    parser.add_argument("--duration", type=float, default=30, help="seconds to run the runtime")
+    parser.add_argument("--plcs", type=int, default=1)
+    parser.add_argument("--plc-latency", type=float, default=0.002)
+    parser.add_argument("--noise", type=int, default=5, help="random noise added to PLC registers")
+    parser.add_argument("--deadband", type=float, default=0)
+    parser.add_argument("--sampling-interval", type=float, default=2)
+    parser.add_argument("--polling-interval", type=float, default=5)
+    parser.add_argument("--batch-size", type=int, default=100)
+    parser.add_argument("--encoding", default="nested")
+    parser.add_argument("--latency-scale", type=float, default=1.0, help="multiplier for simulated AT latencies")
+    parser.add_argument("--loss", type=float, default=0.0, help="probability of a dropped modem response")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--outage", choices=LinkSupervisor.levels, help="drop the link at this level during the run")
+    parser.add_argument("--outage-at", type=float, help="seconds after start to drop the link (default: duration / 3)")
+    parser.add_argument("--cold", action="store_true", help="start from a powered-on modem with factory settings")
+    parser.add_argument("--restart", action="store_true", help="run again with the same modem and storage and report the warm start")
+    parser.add_argument("--pty", action="store_true", help="talk to the simulated modem through a pseudo terminal")
+    parser.add_argument("--output", help="write the result as JSON")
+    parser.add_argument("--baseline", help="JSON result to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+
+    result, fake, workdir = run(args)
+    if args.restart:
+        if args.pty:
+            print("--restart is not supported with --pty")
+            sys.exit(2)
+        warm, _, _ = run(args, fake, workdir)
+        print(f"cold bring_up: {result['bring_up']} ms, first_sample: {result['first_sample']} ms")
+        result = warm
+    for key, value in result.items():
+        print(f"{key}: {value}")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(result, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"regression: {regression}")
+        if regressions:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+import os
+import sys
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench.fake_plc import FakePLC
+from src.kv8000 import KV8000
+
+def run_connect_per_command(host, port, commands):
+    start = time.perf_counter()
+    for i in range(commands):
+        kv8000 = KV8000(host, port)
+        if kv8000.connect():
+            kv8000.send_command("RDS DM5000 1\r")
+        kv8000.disconnect()
+    return commands / (time.perf_counter() - start)
+
+# 運用時と同じく接続を使い回す
+def run_persistent(host, port, commands):
+    kv8000 = KV8000(host, port)
+    kv8000.connect()
+    start = time.perf_counter()
+    for i in range(commands):
+        kv8000.send_command("RDS DM5000 1\r")
+    rate = commands / (time.perf_counter() - start)
+    kv8000.disconnect()
+    return rate
+
+def run_snapshot(host, port, snapshots, bulk):
+    kv8000 = KV8000(host, port)
+    kv8000.connect()
+    start = time.perf_counter()
+    for i in range(snapshots):
+        if bulk:
+            kv8000.read_many()
+        else:
+            for name in kv8000.cmd_map:
+                kv8000.parse(kv8000.read(name))
+    rate = snapshots / (time.perf_counter() - start)
+    kv8000.disconnect()
+    return rate
+
+def main():
+    commands = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    plc = FakePLC()
+    host, port = plc.start()
+    legacy = run_connect_per_command(host, port, commands)
+    persistent = run_persistent(host, port, commands)
+    single = run_snapshot(host, port, commands // 10, False)
+    bulk = run_snapshot(host, port, commands // 10, True)
+    plc.stop()
+    print(f"connect-per-command: {legacy:.1f} commands/s")
+    print(f"persistent:          {persistent:.1f} commands/s ({persistent / legacy:.1f}x)")
+    print(f"snapshot (read):      {single:.1f} snapshots/s")
+    print(f"snapshot (read_many): {bulk:.1f} snapshots/s ({bulk / single:.1f}x)")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,44 @@
+import os
+import tty
+import select
+import threading
+
+from bench.modem_sim import FakeModem
+
+# FakeModemを擬似端末の先で動かし、SIM7080Gからは実際のシリアルポートとして見せる
+class PtyModem:
+    def __init__(self, **options):
+        self.modem = FakeModem(**options)
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.slave)
+        self.port = os.ttyname(self.slave)
+        self.running = False
+        self.thread = None
+
+    def pump(self):
+        buffer = b''
+        while self.running:
+            readable, _, _ = select.select([self.master], [], [], 0.001)
+            if readable:
+                try:
+                    buffer += os.read(self.master, 4096)
+                except OSError:
+                    return
+                while b'\r\n' in buffer:
+                    line, buffer = buffer.split(b'\r\n', 1)
+                    self.modem.write(line + b'\r\n')
+            if self.modem.inWaiting():
+                os.write(self.master, self.modem.read(self.modem.inWaiting()))
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.pump, daemon=True)
+        self.thread.start()
+        return self.port
+
+    def stop(self):
+        self.running = False
+        if self.thread:
+            self.thread.join()
+        os.close(self.master)
+        os.close(self.slave)
@@ -1,170 +1,124 @@
 import os
 import sys
-import json
-import time
-import keyboard
+import asyncio
 
 sys.path.append("src")
 
-from src.kv8000 import KV8000
 from src.sim7080g import SIM7080G
+from src.session import HTTPSSession
+from src.batch import MeasureBatch
+from src.measure_queue import MeasureQueue
+from src.state_store import StateStore
+from src.encoder import get_encoder
+from src.action_sync import ActionSync
+from src.scheduler import SamplingScheduler
+from src.filter import DeadbandFilter
+from src.runtime import AsyncSIM7080G, Runtime
+from src.devices import DeviceRegistry, PLCFanOut
+from src.link_supervisor import LinkSupervisor
 
 device_id = "00000001"
-host_ip = "192.168.0.10"
-host_port = 8501
+# 接続先のPLC (最初のPLCが既定の接続先)
+# schemaでレジスタごとのデータ形式を指定できる (例: {"waste_oil_heater_temp": {"type": "S", "scale": 0.1, "unit": "°C"}})
+plcs = {
+    "kv8000": {"host": "192.168.0.10", "port": 8501}
+}
+# plantId/controlId/sensorIdごとの接続先
+plc_routes = {
+    "plantId": {},
+    "controlId": {},
+    "sensorId": {}
+}
+max_plc_workers = 4
 polling_interval = 20
+sampling_interval = 20
+sampling_cache_ttl = 1
+# レジスタごとのサンプリング周期 [秒] (未指定はsampling_interval)
+sampling_periods = {
+    "waste_oil_pump_flow_setting": 300,
+    "waste_oil_tank_upper_limit": 300,
+    "meoh_level_upper_limit": 300,
+    "waste_oil_heater_setting": 300,
+    "inline_heater_setting": 300,
+    "auto_heating_pump_flow_setting": 300,
+    "auto_operation_inline_heater_temp": 300,
+    "moisture_removal_timer": 60
+}
+# レジスタごとの不感帯 (absolute/percentを超える変化かheartbeat秒経過で送信、windowで間引き)
+deadband_default = {
+    "absolute": 0,
+    "heartbeat": 300
+}
+deadbands = {
+    "meoh_level": {"absolute": 0.5},
+    "waste_oil_tank_level": {"absolute": 0.5},
+    "waste_oil_heater_temp": {"absolute": 0.2},
+    "waste_oil_pump_flow": {"percent": 1, "window": 60, "mode": "mean"},
+    "meoh_pump_flow": {"percent": 1, "window": 60, "mode": "mean"}
+}
 max_polling_count = 10
+min_polling_interval = 5
+max_polling_interval = 120
+max_batch_size = 100
+max_batch_age = 0
+max_queue_rows = 100000
+queue_eviction = "drop_oldest"
+payload_encoding = "nested"  # nested, flat, columnar (+deflate)
 
 count_file_path = f"{os.path.dirname(__file__)}/storage/count.txt"
+queue_file_path = f"{os.path.dirname(__file__)}/storage/measure.db"
+state_file_path = f"{os.path.dirname(__file__)}/storage/state.json"
+metrics_file_path = f"{os.path.dirname(__file__)}/storage/metrics.json"
+metrics_interval = 300
 
 def main():
     try:
         sim7080g = SIM7080G(port='/dev/ttyAMA0', baudrate=115200, debug=True)
         sim7080g.set_apn("soracom.io")
-
-        if not sim7080g.init():
-            raise Exception("Failed to initialize SIM7080G")
-
-        sim7080g.set_network()
-        sim7080g.check_network()
+        state = StateStore(state_file_path, legacy_count_path=count_file_path)
 
         endpoint = "http://funk.soracom.io"
         headers = {
             "Content-Type": "application/json"
         }
-
-        # deviceテーブルを更新する
-        data = {
-            "active": True
-        }
-        params = {
-            "table": "device",
-            "action": "update",
-            "condition": "deviceId=eq.00000001",
-            "data": json.dumps(data)
-        }
-        request_body = json.dumps({
-            "body": json.dumps(params)
-        })
-        response = sim7080g.https_post(
-            url=endpoint,
-            headers=headers,
-            body=request_body
+        session = HTTPSSession(sim7080g, endpoint, headers)
+        # モデムの起動はRuntimeでサンプリングと並行して行い、前回接続できた設定はstateに保存する
+        # 通信が切れたときはSH→PDP→再登録→CFUNの順に必要な段階から復旧する
+        link = LinkSupervisor(sim7080g, session, state=state)
+        encoder = get_encoder(payload_encoding)
+        batch = MeasureBatch(max_batch_size, max_batch_age, session.bodylen, encoder)
+
+        # 測定値は送信前にローカルのキューに保存する
+        queue = MeasureQueue(queue_file_path, max_queue_rows, queue_eviction)
+        sync = ActionSync(state, device_id, max_polling_count, min_polling_interval, max_polling_interval)
+
+        # PLCとの接続はポーリング間で使い回し、複数のPLCは並列に読み出す
+        registry = DeviceRegistry(plcs, plc_routes)
+        plc_fanout = PLCFanOut(registry, max_plc_workers)
+        scheduler = SamplingScheduler(plc_fanout.cmd_map, sampling_periods, sampling_interval, sampling_cache_ttl, registry)
+
+        # SIGINT/SIGTERMを受信するまでサンプリングと送信を続ける
+        runtime = Runtime(
+            modem=AsyncSIM7080G(session),
+            plcs=plc_fanout,
+            scheduler=scheduler,
+            batch=batch,
+            queue=queue,
+            state=state,
+            sync=sync,
+            device_id=device_id,
+            polling_interval=polling_interval,
+            sampling_interval=sampling_interval,
+            encoder=encoder,
+            filter=DeadbandFilter(deadbands, deadband_default),
+            metrics_path=metrics_file_path,
+            metrics_interval=metrics_interval,
+            link=link
         )
-
-        if(response.get("status") != 200):
-            raise Exception("Failed to update device table")
-        
-        while True:
-            if keyboard.read_event(): 
-                break
-
-            # countを取得する
-            if os.path.exists(count_file_path):
-                with open(count_file_path, "r") as f:
-                    count = int(f.read())
-
-            # actionテーブルから取得する
-            params = {
-                "table": "action",
-                "action": "select",
-                "query": f"deviceId=eq.00000001&count=eq.{count}"
-            }
-            request_body = json.dumps({
-                "body": json.dumps(params)
-            })
-            response = sim7080g.https_post(
-                url=endpoint,
-                headers=headers,
-                body=request_body
-            )
-
-            if(response.get("status") != 200):
-                raise Exception("Failed to select action table")
-
-            response_body = json.loads(response.get("body"))
-
-            for action in json.loads(response_body.get("data")):
-                plant_id = action.get("plantId")
-                control_id = action.get("controlId")                
-                sensor_id = action.get("sensorId")
-                count = action.get("count")
-                command = action.get("command")
-
-                if control_id:
-                    # コマンドを送信する
-                    kv8000 = KV8000(host_ip, host_port)
-
-                    if kv8000.connect():
-                        response = kv8000.send_command(command)
-                    else:
-                        raise Exception("Failed to connect to KV8000")
-                    
-                    # 接続を切断
-                    kv8000.disconnect()
-                        
-                if sensor_id:
-                    # countを更新する
-                    os.makedirs(os.path.dirname(count_file_path), exist_ok=True)
-                    with open(count_file_path, "w") as file:
-                        file.write(str(count))
-
-                    # コマンドを送信する
-                    kv8000 = KV8000(host_ip, host_port)
-
-                    if kv8000.connect():
-                        response = kv8000.send_command(command)
-                        if response:
-                            value = kv8000.parse(response)
-                            print("Value:", value)
-                    else: 
-                        raise Exception("Failed to connect to KV8000")
-                    
-                    # 接続を切断
-                    kv8000.disconnect()
-
-                    # measureテーブルに挿入する
-                    data = {
-                        "sensorId": sensor_id,
-                        "value": value,
-                        "plantId": plant_id,
-                        "count": count
-                    }
-                    params = {
-                        "table": "measure",
-                        "action": "insert",
-                        "data": json.dumps(data)
-                    }
-                    body = json.dumps({
-                        "body": json.dumps(params)
-                    })
-                    response = sim7080g.https_post(
-                        url=endpoint,
-                        headers=headers,
-                        body=body
-                    )
-
-                    if(response.get("status") != 200):
-                        raise Exception("Failed to insert measure table")
-                    
-            time.sleep(polling_interval)
-        
-        # deviceテーブルを更新する
-        data = {
-            "active": False
-        }
-        params = {
-            "table": "device",
-            "action": "update",
-            "condition": "deviceId=eq.00000001",
-            "data": json.dumps(data)
-        }
-        
-        sim7080g.close()
+        asyncio.run(runtime.run())
         
     except Exception as e:
         print(f"Error: {e}")
 
 if __name__ == "__main__":
     main()  
-
@@ -0,0 +1,83 @@
+from collections import deque
+
+class ActionSync:
+    def __init__(self, state, device_id, limit=10, min_interval=5, max_interval=120, backoff=2, history=200):
+        self.state = state
+        self.device_id = device_id
+        self.limit = limit
+        self.page_limit = limit
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.interval = min_interval
+        self.executed = deque(state.get("executed", []), maxlen=history)
+        self.keys = set(self.executed)
+        self.rows = []
+        self.skipped = 0
+        self.latest = False
+
+    def key(self, action):
+        id = action.get("actionId", action.get("id"))
+        if id is not None:
+            return str(id)
+        return f"{action.get('count')}:{action.get('controlId')}:{action.get('sensorId')}:{action.get('command')}"
+
+    # countの最大値より新しい行だけをlimit件まで取得する
+    # カーソルが無い場合 (新規設置) は過去の制御を再実行しないよう、最新のcountだけを調べる
+    def query(self):
+        self.rows = []
+        self.latest = self.state.get("count") is None
+        if self.latest:
+            return f"deviceId=eq.{self.device_id}&order=count.desc&limit=1"
+        return f"deviceId=eq.{self.device_id}&count=gt.{self.state.get('count')}&order=count.asc&limit={self.page_limit}"
+
+    # 実行済みのactionはFalseを返す
+    def accept(self, action):
+        self.rows.append(action)
+        if self.latest:
+            return False
+        key = self.key(action)
+        if key in self.keys:
+            self.skipped += 1
+            return False
+        if len(self.executed) == self.executed.maxlen:
+            self.keys.discard(self.executed[0])
+        self.executed.append(key)
+        self.keys.add(key)
+        return True
+
+    # カーソルを進めて次の取得までの間隔を返す
+    def finish(self):
+        counts = [action.get("count") for action in self.rows if action.get("count") is not None]
+        if self.latest:
+            # 次の取得で最新のcountの行だけを実行する
+            self.state.set("count", max(counts) - 1 if counts else 0)
+            self.interval = self.min_interval
+            return 0
+        full = len(self.rows) >= self.page_limit
+        if counts:
+            if full:
+                # 最後のcountは途中までしか取得していない可能性がある
+                complete = [count for count in counts if count < counts[-1]]
+                if complete:
+                    self.state.set("count", max(complete))
+                    self.page_limit = self.limit
+                else:
+                    self.page_limit *= 2
+            else:
+                self.state.set("count", max(counts))
+                self.page_limit = self.limit
+        self.state.set("executed", list(self.executed))
+
+        if full:
+            self.interval = self.min_interval
+            return 0
+        if self.rows:
+            self.interval = self.min_interval
+        else:
+            self.interval = min(self.interval * self.backoff, self.max_interval)
+        return self.interval
+
+    def fail(self):
+        self.interval = min(self.interval * self.backoff, self.max_interval)
+        return self.interval
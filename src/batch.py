@@ -0,0 +1,58 @@
+import time
+
+from src.encoder import NestedJSONEncoder
+
+class MeasureBatch:
+    def __init__(self, max_size=100, max_age=0, bodylen=4096, encoder=None):
+        self.max_size = max_size
+        self.max_age = max_age
+        self.bodylen = bodylen
+        self.encoder = encoder if encoder else NestedJSONEncoder()
+        self.rows = []
+        self.created_at = None
+
+    def add(self, row, created_at=None):
+        if not self.rows:
+            self.created_at = created_at if created_at else time.time()
+        self.rows.append(row)
+
+    def clear(self):
+        self.rows = []
+        self.created_at = None
+
+    def is_full(self):
+        return len(self.rows) >= self.max_size
+
+    def should_flush(self):
+        if not self.rows:
+            return False
+        if self.is_full():
+            return True
+        return time.time() - self.created_at >= self.max_age
+
+    def encode(self, rows):
+        start = time.perf_counter()
+        body = self.encoder.dump({
+            "table": "measure",
+            "action": "insert",
+            "data": rows
+        })
+        return body, time.perf_counter() - start
+
+    # BODYLENを超える場合は半分ずつに分割する (分割前のbodyはencoderの統計に含めない)
+    def split(self, rows):
+        body, elapsed = self.encode(rows)
+        if len(body) <= self.bodylen or len(rows) == 1:
+            return [(rows, body, elapsed)]
+        half = len(rows) // 2
+        return self.split(rows[:half]) + self.split(rows[half:])
+
+    def flush(self, post):
+        for rows, body, elapsed in self.split(self.rows):
+            self.encoder.record(body, elapsed)
+            response = post(body)
+            if response.get("code") != 200:
+                return False
+            self.rows = self.rows[len(rows):]
+        self.created_at = None
+        return True
@@ -0,0 +1,86 @@
+import asyncio
+
+from src.runtime import AsyncKV8000
+
+class DeviceRegistry:
+    def __init__(self, plcs, routes={}, default=None):
+        self.plcs = plcs
+        self.routes = routes
+        self.default = default if default else next(iter(plcs))
+
+    # sensorId, controlId, plantIdの順に接続先のPLCを探す
+    def resolve(self, action):
+        for field in ("sensorId", "controlId", "plantId"):
+            name = self.routes.get(field, {}).get(action.get(field))
+            if name:
+                return name
+        return self.default
+
+class PLCFanOut:
+    def __init__(self, registry, max_workers=4, timeout=10):
+        self.registry = registry
+        self.max_workers = max_workers
+        self.clients = {
+            name: AsyncKV8000(plc["host"], plc["port"], timeout, plc.get("schema"))
+            for name, plc in registry.plcs.items()
+        }
+        self.cmd_map = next(iter(self.clients.values())).cmd_map
+        self.locks = None
+        self.semaphore = None
+
+    def resolve(self, action):
+        return self.registry.resolve(action)
+
+    # 同時に扱うPLCの数をmax_workersに制限し、PLCごとのコマンドは直列に送る
+    async def call(self, name, method, *args):
+        if self.locks is None:
+            self.locks = {name: asyncio.Lock() for name in self.clients}
+            self.semaphore = asyncio.Semaphore(self.max_workers)
+        client = self.clients.get(name)
+        if not client:
+            print(f"Unknown PLC: {name}\r\n")
+            return None
+        # 先にPLCごとのロックを取り、応答の遅いPLCを待つタスクが枠を占有しないようにする
+        async with self.locks[name], self.semaphore:
+            return await getattr(client, method)(*args)
+
+    async def send_command(self, name, command):
+        return await self.call(name, "send_command", command)
+
+    # cmd_mapのレジスタはRDSにまとめ、それ以外のコマンドと一緒に1回で送信する
+    async def read(self, name, registers):
+        client = self.clients.get(name)
+        if not client:
+            print(f"Unknown PLC: {name}\r\n")
+            return {}
+        groups = client.plan([register for register in registers if register in self.cmd_map])
+        commands = [register for register in registers if register not in self.cmd_map]
+        responses = await self.call(name, "pipeline", [group["command"] for group in groups] + [command + "\r" for command in commands])
+        if responses is None:
+            print(f"Failed to read {name}\r\n")
+            return {}
+
+        values = {}
+        for group, response in zip(groups, responses):
+            values.update(client.split(group, response))
+        for command, response in zip(commands, responses[len(groups):]):
+            values[command] = self.parse(response)
+        return {register: value for register, value in values.items() if value is not None}
+
+    # PLCごとに並列に読み出し、(PLC名, レジスタ)をキーにまとめて返す
+    async def read_all(self, groups):
+        results = await asyncio.gather(*[self.read(name, registers) for name, registers in groups.items()])
+        values = {}
+        for name, result in zip(groups, results):
+            values.update({(name, register): value for register, value in result.items()})
+        return values
+
+    def parse(self, response):
+        return next(iter(self.clients.values())).parse(response)
+
+    def health(self):
+        return {name: client.health() for name, client in self.clients.items()}
+
+    async def disconnect(self):
+        for client in self.clients.values():
+            await client.disconnect()
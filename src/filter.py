@@ -0,0 +1,89 @@
+import math
+from array import array
+
+class DeadbandFilter:
+    defaults = {
+        "absolute": 0,
+        "percent": 0,
+        "heartbeat": 300,
+        "window": 0,
+        "mode": "mean"
+    }
+
+    def __init__(self, configs={}, default={}):
+        self.configs = configs
+        self.default = {**self.defaults, **default}
+        self.index = {}
+        # センサーごとの状態は配列に詰めて持つ
+        self.last_value = array("d")
+        self.last_time = array("d")
+        self.window_start = array("d")
+        self.window_min = array("d")
+        self.window_max = array("d")
+        self.window_sum = array("d")
+        self.window_count = array("l")
+        self.passed = 0
+        self.suppressed = 0
+
+    def config(self, register):
+        return {**self.default, **self.configs.get(register, {})}
+
+    def slot(self, key):
+        index = self.index.get(key)
+        if index is None:
+            index = self.index[key] = len(self.last_value)
+            self.last_value.append(math.nan)
+            self.last_time.append(-math.inf)
+            self.window_start.append(-math.inf)
+            self.window_min.append(math.inf)
+            self.window_max.append(-math.inf)
+            self.window_sum.append(0)
+            self.window_count.append(0)
+        return index
+
+    # windowの間は集計し、窓が閉じたときに最小/最大/平均を返す
+    def downsample(self, index, config, value, now):
+        if self.window_count[index] == 0:
+            self.window_start[index] = now
+        self.window_min[index] = min(self.window_min[index], value)
+        self.window_max[index] = max(self.window_max[index], value)
+        self.window_sum[index] += value
+        self.window_count[index] += 1
+        if now - self.window_start[index] < config["window"]:
+            return None
+
+        if config["mode"] == "min":
+            value = self.window_min[index]
+        elif config["mode"] == "max":
+            value = self.window_max[index]
+        else:
+            value = self.window_sum[index] / self.window_count[index]
+        self.window_min[index] = math.inf
+        self.window_max[index] = -math.inf
+        self.window_sum[index] = 0
+        self.window_count[index] = 0
+        return value
+
+    # 送信すべき値を返し、不要な場合はNoneを返す
+    def process(self, key, register, value, now):
+        config = self.config(register)
+        index = self.slot(key)
+
+        if config["window"] > 0:
+            value = self.downsample(index, config, value, now)
+            if value is None:
+                self.suppressed += 1
+                return None
+
+        last = self.last_value[index]
+        changed = math.isnan(last) or abs(value - last) > config["absolute"]
+        if changed and not math.isnan(last) and config["percent"] > 0:
+            changed = abs(value - last) > abs(last) * config["percent"] / 100
+        if not changed and now - self.last_time[index] < config["heartbeat"]:
+            self.suppressed += 1
+            return None
+
+        self.last_value[index] = value
+        self.last_time[index] = now
+        self.passed += 1
+        return value
@@ -0,0 +1,147 @@
+import json
+
+# JSON配列を少しずつ受け取り、要素が揃うたびに返す
+class ArrayParser:
+    def __init__(self):
+        self.started = False
+        self.done = False
+        self.depth = 0
+        self.in_string = False
+        self.escape = False
+        self.item = []
+
+    def feed(self, text):
+        items = []
+        for char in text:
+            if self.done:
+                break
+            if not self.started:
+                if char == "[":
+                    self.started = True
+                continue
+
+            if self.in_string:
+                self.item.append(char)
+                if self.escape:
+                    self.escape = False
+                elif char == "\\":
+                    self.escape = True
+                elif char == '"':
+                    self.in_string = False
+                continue
+
+            if self.depth == 0 and char in ",]":
+                item = "".join(self.item).strip()
+                self.item = []
+                if item:
+                    items.append(json.loads(item))
+                if char == "]":
+                    self.done = True
+                continue
+
+            if char == '"':
+                self.in_string = True
+            elif char in "[{":
+                self.depth += 1
+            elif char in "]}":
+                self.depth -= 1
+            self.item.append(char)
+        return items
+
+# {"key": [...]} または {"key": "[...]"} のkeyの配列の要素を順に返す
+class ResponseParser:
+    def __init__(self, key="data"):
+        self.key = key
+        self.array = ArrayParser()
+        self.depth = 0
+        self.in_string = False
+        self.escape = False
+        self.token = []
+        self.last_string = None
+        self.state = "search"
+        self.unicode = None
+
+    @property
+    def done(self):
+        return self.array.done
+
+    def feed(self, text):
+        items = []
+        for char in text:
+            if self.state == "search":
+                self.search(char)
+            elif self.state == "value":
+                if char == '"':
+                    self.state = "string"
+                elif char == "[":
+                    self.state = "array"
+                    items.extend(self.array.feed(char))
+                elif not char.isspace():
+                    raise ValueError(f"Unexpected value for {self.key}")
+            elif self.state == "array":
+                items.extend(self.array.feed(char))
+            elif self.state == "string":
+                char = self.unescape(char)
+                if char:
+                    items.extend(self.array.feed(char))
+            if self.array.done:
+                self.state = "done"
+                break
+        return items
+
+    def search(self, char):
+        if self.in_string:
+            if self.escape:
+                self.escape = False
+            elif char == "\\":
+                self.escape = True
+            elif char == '"':
+                self.in_string = False
+                self.last_string = "".join(self.token)
+                return
+            self.token.append(char)
+            return
+
+        if char == '"':
+            self.in_string = True
+            self.token = []
+        elif char in "[{":
+            self.depth += 1
+        elif char in "]}":
+            self.depth -= 1
+        elif char == ":" and self.depth == 1 and self.last_string == self.key:
+            self.state = "value"
+        elif not char.isspace():
+            self.last_string = None
+
+    # 文字列として埋め込まれたJSONを1文字ずつ復元する
+    def unescape(self, char):
+        if self.unicode is not None:
+            self.unicode += char
+            if len(self.unicode) < 4:
+                return None
+            char, self.unicode = chr(int(self.unicode, 16)), None
+            return char
+        if self.escape:
+            self.escape = False
+            if char == "u":
+                self.unicode = ""
+                return None
+            return {"n": "\n", "t": "\t", "r": "\r", "b": "\b", "f": "\f"}.get(char, char)
+        if char == "\\":
+            self.escape = True
+            return None
+        if char == '"':
+            self.state = "done"
+            return None
+        return char
+
+# 配列の終わりまで届かずに入力が終わった場合はValueError
+def iter_items(chunks, key="data"):
+    parser = ResponseParser(key)
+    for chunk in chunks:
+        for item in parser.feed(chunk):
+            yield item
+        if parser.done:
+            return
+    raise ValueError(f"Response ended before the end of {key}")
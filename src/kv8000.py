@@ -1,11 +1,21 @@
+import sys
+import time
 import socket
+from array import array
+
+from src.metrics import metrics
 
 class KV8000:
-    def __init__(self, host_ip, host_port, timeout=10):
+    # データ形式ごとのワード数と、RDSで読み出すときの形式 (Fは.Dで読み出してfloat32として解釈する)
+    words = {"U": 1, "S": 1, "H": 1, "D": 2, "L": 2, "F": 2}
+    suffixes = {"U": "U", "S": "S", "H": "H", "D": "D", "L": "L", "F": "D"}
+
+    def __init__(self, host_ip, host_port, timeout=10, schema=None):
         self.host_ip = host_ip
         self.host_port = host_port
         self.timeout = timeout
         self.client = None
+        self.buffer = b''
 
         self.cmd_map = {
             "waste_oil_tank_level": "RDS DM5000",               # 廃油タンクレベル [L]
@@ -23,24 +33,88 @@ class KV8000:
             "moisture_removal_timer": "RDS DM124"               # 水分除去タイマー [分]
         }
 
+        # レジスタごとのデータ形式 (type: U/S/H/D/L/F, scale: 倍率, unit: 単位)
+        # 未指定のレジスタは従来通り.Uの値を1/100にする
+        self.schema = {
+            "waste_oil_tank_level": {"unit": "L"},
+            "meoh_level": {"unit": "L"},
+            "waste_oil_heater_temp": {"unit": "°C"},
+            "waste_oil_pump_flow_setting": {"unit": "L/H"},
+            "waste_oil_tank_upper_limit": {"unit": "L"},
+            "meoh_level_upper_limit": {"unit": "L"},
+            "waste_oil_heater_setting": {"unit": "°C"},
+            "inline_heater_setting": {"unit": "°C"},
+            "waste_oil_pump_flow": {"unit": "L/H"},
+            "meoh_pump_flow": {"unit": "L/H"},
+            "auto_heating_pump_flow_setting": {"unit": "L/H"},
+            "auto_operation_inline_heater_temp": {"unit": "°C"},
+            "moisture_removal_timer": {"unit": "min"}
+        }
+        for name, format in (schema or {}).items():
+            if "scale" in format and not format["scale"] > 0:
+                raise ValueError(f"Invalid scale for {name}: {format['scale']}")
+            self.schema[name] = {**self.schema.get(name, {}), **format}
+
     def connect(self):
+        start = time.perf_counter()
         try:
             self.client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self.client.settimeout(self.timeout)
+            self.client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
             self.client.connect((self.host_ip, self.host_port))
+            self.buffer = b''
+            metrics.observe("plc.connect", time.perf_counter() - start)
             print("PLC connection success\r\n")
             return True
         except socket.timeout:
+            metrics.count("plc.connect_error")
             print("PLC connection timeout\r\n")
+            self.client = None
             return False
         except Exception as e:
+            metrics.count("plc.connect_error")
             print(f"PLC connection failed: {e}")
+            self.client = None
             return False
 
     def disconnect(self):
         if self.client:
             self.client.close()
+            self.client = None
+            self.buffer = b''
             print("PLC connection closed\r\n")
+
+    # 応答は\r\nで終端されるため、分割・結合されて届いても1行ずつ取り出す
+    def recv_line(self):
+        while b'\r\n' not in self.buffer:
+            data = self.client.recv(1024)
+            if not data:
+                raise ConnectionError("PLC connection closed by peer")
+            metrics.count("plc.rx_bytes", len(data))
+            self.buffer += data
+        line, self.buffer = self.buffer.split(b'\r\n', 1)
+        return line.decode("ascii").strip()
+
+    # 複数のコマンドをまとめて送信し、応答を送信順に返す
+    def pipeline(self, commands):
+        if not self.client:
+            print("Not connected to PLC\r\n")
+            return None
+
+        try:
+            start = time.perf_counter()
+            data = "".join(commands).encode("ascii")
+            self.client.sendall(data)
+            metrics.count("plc.tx_bytes", len(data))
+            responses = [self.recv_line() for _ in commands]
+            metrics.observe(self.command_name(commands), time.perf_counter() - start)
+            return responses
+        except Exception as e:
+            metrics.count("plc.error")
+            print(f"Failed to send commands: {e}")
+            # 応答の対応関係が崩れるため接続し直す
+            self.disconnect()
+            return None
     
     def send_command(self, command):
         if not self.client:
@@ -48,11 +122,16 @@ class KV8000:
             return None
 
         try:
-            self.client.send(command.encode("ascii"))
-            response = self.client.recv(1024).decode("ascii").strip()
+            start = time.perf_counter()
+            self.client.sendall(command.encode("ascii"))
+            metrics.count("plc.tx_bytes", len(command))
+            response = self.recv_line()
+            metrics.observe(self.command_name([command]), time.perf_counter() - start)
             return response
         except Exception as e:
+            metrics.count("plc.error")
             print(f"Failed to send command: {e}")
+            self.disconnect()
             return None
 
     def read(self, name, length=1):
@@ -66,13 +145,123 @@ class KV8000:
             return None
 
         try:
+            start = time.perf_counter()
             command = f"{command} {length}\r"
-            self.client.send(command.encode("ascii"))
-            response = self.client.recv(1024).decode("ascii").strip()
+            self.client.sendall(command.encode("ascii"))
+            metrics.count("plc.tx_bytes", len(command))
+            response = self.recv_line()
+            metrics.observe(self.command_name([command]), time.perf_counter() - start)
             return response
         except Exception as e:
+            metrics.count("plc.error")
             print(f"Failed to read DM: {e}")
+            self.disconnect()
+            return None
+
+    # 複数のコマンドをまとめて送信した場合はpipelineとして集計する
+    def command_name(self, commands):
+        if len(commands) > 1:
+            return "plc.pipeline"
+        parts = commands[0].split()
+        return f"plc.{parts[0].upper() if parts else 'EMPTY'}"
+
+    def format(self, name):
+        return {"type": "U", "scale": 0.01, "unit": "", **self.schema.get(name, {})}
+
+    # 同じデバイス・読み出し形式で連続したDMをまとめて1回のRDSで読み出す
+    def plan(self, names, max_gap=128, max_count=1000):
+        registers = []
+        for name in dict.fromkeys(names):
+            command = self.cmd_map.get(name)
+            if not command:
+                print(f"Invalid sensor name: {name}\r\n")
+                continue
+            format = self.format(name)
+            if format["type"] not in self.words:
+                print(f"Invalid data type for {name}: {format['type']}\r\n")
+                continue
+            device = command.split()[1]
+            prefix = device.rstrip("0123456789")
+            registers.append((prefix, self.suffixes[format["type"]], int(device[len(prefix):]), name, format))
+        registers.sort(key=lambda register: register[:3])
+
+        groups = []
+        for prefix, suffix, address, name, format in registers:
+            words = self.words[format["type"]]
+            if groups:
+                group = groups[-1]
+                # 2ワードの形式は読み出し単位の境界に揃っている場合だけまとめる
+                if (group["prefix"] == prefix and group["suffix"] == suffix
+                        and address - group["end"] <= max_gap and address + words - group["start"] <= max_count
+                        and (address - group["start"]) % words == 0):
+                    group["end"] = max(group["end"], address + words - 1)
+                    group["names"].append((name, address, format))
+                    continue
+            groups.append({
+                "prefix": prefix,
+                "suffix": suffix,
+                "words": words,
+                "start": address,
+                "end": address + words - 1,
+                "names": [(name, address, format)]
+            })
+
+        for group in groups:
+            device = f"{group['prefix']}{group['start']}" + (f".{group['suffix']}" if group["suffix"] != "U" else "")
+            group["command"] = f"RDS {device} {(group['end'] - group['start'] + 1) // group['words']}\r"
+        return groups
+
+    # RDSの応答全体を1回で数値の配列に変換し、レジスタごとに型と倍率を適用する
+    def decode(self, group, response):
+        fields = response.split() if response else []
+        try:
+            if group["suffix"] == "H":
+                values = array("H", bytes.fromhex("".join(fields)))
+                if sys.byteorder == "little":
+                    values.byteswap()
+            else:
+                values = array("q", map(int, fields))
+        except ValueError as e:
+            print(f"Failed to decode response: {e}")
+            return array("q")
+        return values
+
+    def split(self, group, response):
+        values = self.decode(group, response)
+        floats = None
+        result = {}
+        for name, address, format in group["names"]:
+            index = (address - group["start"]) // group["words"]
+            if index >= len(values):
+                result[name] = None
+                continue
+            if format["type"] == "F":
+                if floats is None:
+                    floats = array("f", array("I", values).tobytes())
+                value = floats[index]
+            else:
+                value = values[index]
+            result[name] = self.scale(value, format["scale"])
+        return result
+
+    # 1/100など1/Nの倍率は割り算にして丸め誤差を出さない
+    def scale(self, value, scale):
+        if scale == 1:
+            return value
+        divisor = 1 / scale
+        if scale < 1 and abs(divisor - round(divisor)) < 1e-9:
+            return value / round(divisor)
+        return value * scale
+
+    def read_many(self, names=None):
+        groups = self.plan(names if names is not None else self.cmd_map)
+        responses = self.pipeline([group["command"] for group in groups]) if groups else []
+        if responses is None:
             return None
+        result = {}
+        for group, response in zip(groups, responses):
+            result.update(self.split(group, response))
+        return result
 
     def parse(self, response):
         try:
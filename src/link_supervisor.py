@@ -0,0 +1,164 @@
+import time
+
+from src.metrics import metrics
+
+class LinkSupervisor:
+    # 復旧の段階 (軽いものから順に試す)
+    levels = ("sh", "pdp", "register", "cfun")
+
+    def __init__(self, sim7080g, session, attach_timeout=60, register_timeout=20, pdp_timeout=10, state=None):
+        self.sim7080g = sim7080g
+        self.session = session
+        self.state = state
+        self.attach_timeout = attach_timeout
+        # 再登録で戻らない場合は早めにCFUNに進む
+        self.register_timeout = register_timeout
+        self.pdp_timeout = pdp_timeout
+        self.registered = None
+        self.pdp = None
+        self.sh = None
+        self.rssi = None
+        self.system = None
+        self.down_since = None
+        self.recoveries = {level: 0 for level in self.levels}
+        sim7080g.add_handler(self.handle)
+
+    # URCと問い合わせの応答から回線の状態を更新する
+    def handle(self, line):
+        name, _, value = line.partition(":")
+        fields = [field.strip().strip('"') for field in value.split(",")]
+        if name == "+APP PDP" and len(fields) >= 2:
+            self.pdp = fields[1] == "ACTIVE"
+            if not self.pdp:
+                self.sh = False
+        elif name == "+SHSTATE":
+            self.sh = fields[0] == "1"
+        elif name == "+CGATT":
+            self.registered = fields[0] == "1"
+        elif name == "+CEREG" and len(fields) >= 2:
+            self.registered = fields[1] in ("1", "5")
+        elif name == "+CNACT" and len(fields) >= 2 and fields[0] == "0":
+            self.pdp = fields[1] == "1"
+        elif name == "+CSQ":
+            self.rssi = None if fields[0] in ("", "99") else int(fields[0])
+        elif name == "+CPSI":
+            self.system = fields[0]
+            if self.system == "NO SERVICE":
+                self.registered = False
+
+    def probe(self):
+        self.sim7080g.send_at_command("AT+CSQ", "OK")
+        self.sim7080g.send_at_command("AT+CPSI?", "OK")
+        self.sim7080g.send_at_command("AT+CGATT?", "OK")
+        self.sim7080g.send_at_command("AT+CNACT?", "OK")
+
+    # 状態を問い合わせ、復旧を始める段階を返す
+    def diagnose(self):
+        self.probe()
+        if not self.registered:
+            return "register"
+        if not self.pdp:
+            return "pdp"
+        return "sh"
+
+    def reconnect(self):
+        self.sim7080g.close()
+        self.session.connected = False
+        return self.session.connect()
+
+    # 'ACTIVE'だけでは+APP PDP: 0,DEACTIVEにも一致するため行全体で判定する
+    # 切断のURCも待ってから接続し、遅れて届いたDEACTIVEを接続の応答と取り違えない
+    def activate(self):
+        self.sim7080g.send_at_command('AT+CNACT=0,0', '+APP PDP: 0,DEACTIVE', 3, urc=True)
+        if not self.sim7080g.send_at_command('AT+CNACT=0,1', '+APP PDP: 0,ACTIVE', self.pdp_timeout, urc=True):
+            return 0
+        self.pdp = True
+        return 1
+
+    def register(self):
+        self.sim7080g.send_at_command('AT+CGATT=0', 'OK', 10)
+        self.sim7080g.send_at_command('AT+CGATT=1', 'OK', 10)
+        return self.sim7080g.wait_attached(self.register_timeout)
+
+    # 無線部を再起動すると設定が失われる可能性があるため、PDPとHTTPの設定も再送する
+    def restart(self):
+        self.sim7080g.send_at_command('AT+CFUN=0', 'OK', 10)
+        self.sim7080g.send_at_command('AT+CFUN=1', 'OK', 10)
+        self.session.applied = {}
+        if not self.sim7080g.wait_attached(self.attach_timeout):
+            return 0
+        return self.sim7080g.set_pdp()
+
+    def run(self, level):
+        if level == "register" and not self.register():
+            return 0
+        if level == "cfun" and not self.restart():
+            return 0
+        if level != "sh" and not self.activate():
+            return 0
+        return self.reconnect()
+
+    def config(self):
+        return {**self.sim7080g.network, "apn": self.sim7080g.apn}
+
+    # 起動時は現在の設定と状態を問い合わせ、済んでいる段階は飛ばす
+    # モジュールの交換や初期化に備えて設定は必ず問い合わせ、異なる場合だけ設定し直す
+    # 正常に接続できた設定はstateに保存し、それと異なる場合は接続済みのPDPも設定し直す
+    def bring_up(self):
+        start = time.monotonic()
+        if not self.sim7080g.init():
+            return 0
+
+        config = self.config()
+        if self.sim7080g.network_settings() != self.sim7080g.network:
+            print("Configuring network\r\n")
+            self.sim7080g.set_network()
+        changed = self.state is not None and self.state.get("modem") != config
+        self.probe()
+        if not self.registered and not self.sim7080g.wait_attached(self.attach_timeout):
+            return 0
+        if not self.pdp or changed:
+            self.sim7080g.set_pdp()
+            if not self.activate():
+                return 0
+        elif self.session.is_connected():
+            # 前回のプロセスのSH接続は設定が分からないため切断しておく
+            self.sim7080g.close()
+
+        if self.state is not None:
+            self.state.set("modem", config)
+        metrics.observe("link.bring_up", time.monotonic() - start)
+        print("Network is ready\r\n")
+        return 1
+
+    # 必要な段階から復旧を試し、失敗したら次の段階に進む (プロセスは終了しない)
+    def recover(self):
+        if self.session.connected and self.session.is_connected():
+            return 1
+        now = time.monotonic()
+        if self.down_since is None:
+            self.down_since = now
+
+        start = self.diagnose()
+        for level in self.levels[self.levels.index(start):]:
+            print(f"Recovering link ({level})\r\n")
+            self.recoveries[level] += 1
+            metrics.count(f"link.recover.{level}")
+            if self.run(level):
+                metrics.observe("link.outage", time.monotonic() - self.down_since)
+                self.down_since = None
+                return 1
+        print("Failed to recover link\r\n")
+        metrics.count("link.recover_error")
+        return 0
+
+    def health(self):
+        return {
+            "registered": self.registered,
+            "pdp": self.pdp,
+            "sh": self.sh,
+            "rssi": self.rssi,
+            "system": self.system,
+            "read_errors": self.sim7080g.reader.errors,
+            "recoveries": dict(self.recoveries)
+        }
@@ -0,0 +1,78 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+
+class MeasureQueue:
+    def __init__(self, path, max_rows=100000, eviction="drop_oldest"):
+        if eviction not in ("drop_oldest", "drop_newest"):
+            raise ValueError(f"Invalid eviction policy: {eviction}")
+        self.path = path
+        self.max_rows = max_rows
+        self.eviction = eviction
+        self.evicted = 0
+        self.lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS measure (id INTEGER PRIMARY KEY AUTOINCREMENT, row TEXT NOT NULL, created_at REAL NOT NULL)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS offset (name TEXT PRIMARY KEY, id INTEGER NOT NULL)")
+        self.db.execute("INSERT OR IGNORE INTO offset (name, id) VALUES ('upload', 0)")
+        self.db.commit()
+
+    def offset(self):
+        with self.lock:
+            return self.db.execute("SELECT id FROM offset WHERE name = 'upload'").fetchone()[0]
+
+    def size(self):
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM measure").fetchone()[0]
+
+    # 上限を超える場合は設定に従って古いデータか新しいデータを捨てる
+    def extend(self, rows):
+        if not rows:
+            return 0
+        with self.lock, self.db:
+            size = self.db.execute("SELECT COUNT(*) FROM measure").fetchone()[0]
+            overflow = size + len(rows) - self.max_rows
+            if overflow > 0:
+                if self.eviction == "drop_newest":
+                    self.evicted += min(overflow, len(rows))
+                    rows = rows[:max(len(rows) - overflow, 0)]
+                else:
+                    self.db.execute("DELETE FROM measure WHERE id IN (SELECT id FROM measure ORDER BY id LIMIT ?)", (min(overflow, size),))
+                    rows = rows[max(overflow - size, 0):]
+                    self.evicted += overflow
+                print(f"Measure queue is full (evicted: {self.evicted})\r\n")
+            now = time.time()
+            self.db.executemany(
+                "INSERT INTO measure (row, created_at) VALUES (?, ?)",
+                [(json.dumps(row), now) for row in rows]
+            )
+        return len(rows)
+
+    def append(self, row):
+        return self.extend([row])
+
+    def peek(self, limit=100):
+        with self.lock:
+            return [
+                (id, json.loads(row), created_at)
+                for id, row, created_at in self.db.execute(
+                    "SELECT id, row, created_at FROM measure WHERE id > (SELECT id FROM offset WHERE name = 'upload') ORDER BY id LIMIT ?",
+                    (limit,)
+                )
+            ]
+
+    # 送信済みのオフセットを記録し、送信済みのデータを削除する
+    def ack(self, id):
+        with self.lock, self.db:
+            self.db.execute("UPDATE offset SET id = ? WHERE name = 'upload' AND id < ?", (id, id))
+            self.db.execute("DELETE FROM measure WHERE id <= ?", (id,))
+
+    def close(self):
+        with self.lock:
+            self.db.close()
@@ -0,0 +1,104 @@
+import os
+import json
+import time
+import bisect
+import threading
+from contextlib import contextmanager
+
+class Histogram:
+    # 上限値 [ms] (最後のバケットはそれ以上)
+    bounds = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 20000, 60000]
+
+    def __init__(self):
+        self.buckets = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        ms = seconds * 1000
+        self.buckets[bisect.bisect_left(self.bounds, ms)] += 1
+        self.count += 1
+        self.total += ms
+        self.max = max(self.max, ms)
+
+    # バケットの上限値で近似したパーセンタイル [ms]
+    def percentile(self, p):
+        if not self.count:
+            return 0
+        target = self.count * p / 100
+        seen = 0
+        for index, count in enumerate(self.buckets):
+            seen += count
+            if seen >= target:
+                return min(self.bounds[index], round(self.max, 1)) if index < len(self.bounds) else round(self.max, 1)
+        return self.max
+
+    def snapshot(self):
+        return {
+            "count": self.count,
+            "mean": round(self.total / self.count, 1) if self.count else 0,
+            "p50": self.percentile(50),
+            "p95": self.percentile(95),
+            "max": round(self.max, 1),
+            "buckets": list(self.buckets)
+        }
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.counters = {}
+        self.started_at = time.time()
+
+    def observe(self, name, seconds):
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.observe(seconds)
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    @contextmanager
+    def timer(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "uptime": round(time.time() - self.started_at),
+                "counters": dict(self.counters),
+                "latency": {name: histogram.snapshot() for name, histogram in self.histograms.items()}
+            }
+
+    # 1行の要約 (名前=件数/p50/p95 [ms])
+    def summary(self):
+        snapshot = self.snapshot()
+        latency = " ".join(
+            f"{name}={value['count']}/{value['p50']}/{value['p95']}"
+            for name, value in sorted(snapshot["latency"].items())
+        )
+        counters = " ".join(f"{name}={value}" for name, value in sorted(snapshot["counters"].items()))
+        return f"[metrics] {latency} | {counters}"
+
+    def write(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f"{path}.tmp"
+        with open(temp_path, "w") as f:
+            json.dump(self.snapshot(), f)
+        os.replace(temp_path, path)
+
+    def reset(self):
+        with self.lock:
+            self.histograms = {}
+            self.counters = {}
+            self.started_at = time.time()
+
+metrics = Metrics()
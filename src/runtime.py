@@ -0,0 +1,472 @@
+import time
+import signal
+import socket
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from src.kv8000 import KV8000
+from src.encoder import NestedJSONEncoder
+from src.json_stream import iter_items
+from src.metrics import metrics
+
+class AsyncKV8000(KV8000):
+    def __init__(self, host_ip, host_port, timeout=10, schema=None, backoff=1, max_backoff=60):
+        super().__init__(host_ip, host_port, timeout, schema)
+        self.reader = None
+        self.writer = None
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.retry_at = 0
+        self.delay = backoff
+        self.connected_before = False
+        self.stats = {
+            "requests": 0,
+            "errors": 0,
+            "connects": 0,
+            "reconnects": 0
+        }
+
+    async def connect(self):
+        start = time.perf_counter()
+        try:
+            self.reader, self.writer = await asyncio.wait_for(
+                asyncio.open_connection(self.host_ip, self.host_port),
+                self.timeout
+            )
+            self.writer.get_extra_info("socket").setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            metrics.observe("plc.connect", time.perf_counter() - start)
+            print("PLC connection success\r\n")
+            return True
+        except asyncio.TimeoutError:
+            metrics.count("plc.connect_error")
+            print("PLC connection timeout\r\n")
+            return False
+        except Exception as e:
+            metrics.count("plc.connect_error")
+            print(f"PLC connection failed: {e}")
+            return False
+
+    async def disconnect(self):
+        if self.writer:
+            self.writer.close()
+            self.reader = None
+            self.writer = None
+            print("PLC connection closed\r\n")
+
+    # 切断されていれば再接続する (失敗時は指数バックオフし、その間は接続を試みない)
+    async def ensure(self):
+        if self.writer:
+            return True
+        now = time.monotonic()
+        if now < self.retry_at:
+            metrics.count("plc.backoff")
+            return False
+        if await self.connect():
+            key = "reconnects" if self.connected_before else "connects"
+            self.stats[key] += 1
+            metrics.count(f"plc.{key}")
+            self.connected_before = True
+            self.retry_at = 0
+            self.delay = self.backoff
+            return True
+        self.retry_at = now + self.delay
+        self.delay = min(self.delay * 2, self.max_backoff)
+        return False
+
+    async def pipeline(self, commands):
+        self.stats["requests"] += 1
+        for attempt in range(2):
+            reused = self.writer is not None
+            if not await self.ensure():
+                break
+            try:
+                start = time.perf_counter()
+                data = "".join(commands).encode("ascii")
+                self.writer.write(data)
+                await self.writer.drain()
+                metrics.count("plc.tx_bytes", len(data))
+                responses = []
+                for _ in commands:
+                    line = await asyncio.wait_for(self.reader.readuntil(b'\r\n'), self.timeout)
+                    metrics.count("plc.rx_bytes", len(line))
+                    responses.append(line.decode("ascii").strip())
+                metrics.observe(self.command_name(commands), time.perf_counter() - start)
+                return responses
+            except Exception as e:
+                metrics.count("plc.error")
+                print(f"Failed to send commands: {e}")
+                await self.disconnect()
+                # 使い回した接続が切れていた場合は1回だけ接続し直して再送する
+                if not reused:
+                    break
+        self.stats["errors"] += 1
+        return None
+
+    def health(self):
+        return {
+            **self.stats,
+            "connected": self.writer is not None,
+            "retry_in": round(max(self.retry_at - time.monotonic(), 0), 1)
+        }
+
+    async def send_command(self, command):
+        responses = await self.pipeline([command])
+        return responses[0] if responses else None
+
+    async def read(self, name, length=1):
+        command = self.cmd_map.get(name)
+        if not command:
+            print("Invalid sensor name\r\n")
+            return None
+        return await self.send_command(f"{command} {length}\r")
+
+    async def read_many(self, names=None):
+        groups = self.plan(names if names is not None else self.cmd_map)
+        responses = await self.pipeline([group["command"] for group in groups]) if groups else []
+        if responses is None:
+            return None
+        result = {}
+        for group, response in zip(groups, responses):
+            result.update(self.split(group, response))
+        return result
+
+# SIM7080Gへのアクセスは専用スレッドで直列に実行する
+class AsyncSIM7080G:
+    def __init__(self, session):
+        self.session = session
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+    async def call(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, func, *args)
+
+    async def post(self, body):
+        return await self.call(self.session.post, body)
+
+    async def close(self):
+        await self.call(self.session.close)
+        self.executor.shutdown()
+        self.session.sim7080g.stop()
+
+class Runtime:
+    def __init__(self, modem, plcs, scheduler, batch, queue, state, sync, device_id, polling_interval=20, sampling_interval=20, queue_size=1000, retry_interval=5, max_retry_interval=300, encoder=None, filter=None, metrics_path=None, metrics_interval=300, link=None):
+        self.modem = modem
+        self.link = link
+        self.plcs = plcs
+        self.scheduler = scheduler
+        self.batch = batch
+        self.queue = queue
+        self.device_id = device_id
+        self.state = state
+        self.sync = sync
+        self.filter = filter
+        self.metrics_path = metrics_path
+        self.metrics_interval = metrics_interval
+        self.encoder = encoder if encoder else NestedJSONEncoder()
+        self.polling_interval = polling_interval
+        self.sampling_interval = sampling_interval
+        self.retry_interval = retry_interval
+        self.max_retry_interval = max_retry_interval
+        self.queue_size = queue_size
+        self.actions = None
+        self.pending = None
+        self.stopping = None
+        self.sensors = {}
+        self.started_at = None
+
+    async def wait(self, seconds):
+        try:
+            await asyncio.wait_for(self.stopping.wait(), seconds)
+        except asyncio.TimeoutError:
+            pass
+
+    def stop(self):
+        print("Stopping...\r\n")
+        self.stopping.set()
+
+    # 状態の保存はサイクルごとに最大1回
+    def checkpoint(self):
+        self.state.set("upload_offset", self.queue.offset())
+        try:
+            self.state.save()
+        except OSError as e:
+            print(f"Failed to save state: {e}")
+
+    # 送信に失敗して接続が切れている場合は、必要な段階から回線を復旧する
+    async def recover(self):
+        if not self.link or self.modem.session.connected:
+            return False
+        return await self.modem.call(self.link.recover)
+
+    # 回線を準備してからactionの取得と送信を始める (その間の測定値はキューに溜まる)
+    async def uplink(self):
+        try:
+            if self.link and not await self.modem.call(self.link.bring_up):
+                print("Network is not ready\r\n")
+            # 起動時に送信できなくても終了せず、回線を復旧しながらサンプリングを続ける
+            if not await self.update_device(True) and not (await self.recover() and await self.update_device(True)):
+                print("Failed to update device table\r\n")
+        except Exception as e:
+            self.failed("uplink", e)
+        await asyncio.gather(self.poll_actions(), self.upload())
+
+    async def update_device(self, active):
+        params = {
+            "table": "device",
+            "action": "update",
+            "condition": f"deviceId=eq.{self.device_id}",
+            "data": {
+                "active": active
+            }
+        }
+        response = await self.modem.post(self.encoder.encode(params))
+        return response.get("code") == 200
+
+    # レスポンスを分割して読み出しながら、actionが揃うたびにキューに入れる (SIM7080Gのスレッドで実行)
+    def select_actions(self, body, loop):
+        response = self.modem.session.post_stream(body)
+        if response.get("code") != 200:
+            return False
+        if not response.get("length"):
+            return True
+        try:
+            for action in iter_items(response.get("chunks")):
+                if self.sync.accept(action):
+                    asyncio.run_coroutine_threadsafe(self.actions.put(action), loop).result()
+        except (ValueError, ConnectionError) as e:
+            # 途中までしか読めていない場合はカーソルを進めない
+            print(f"Failed to parse action table: {e}")
+            return False
+        return True
+
+    # actionテーブルの新しい行だけを取得し、取得間隔は更新の有無で変える
+    async def poll_actions(self):
+        while not self.stopping.is_set():
+            try:
+                params = {
+                    "table": "action",
+                    "action": "select",
+                    "query": self.sync.query()
+                }
+                with metrics.timer("cycle.poll"):
+                    selected = await self.modem.call(self.select_actions, self.encoder.encode(params), asyncio.get_running_loop())
+                if selected:
+                    interval = self.sync.finish()
+                else:
+                    print("Failed to select action table\r\n")
+                    interval = self.sync.min_interval if await self.recover() else self.sync.fail()
+                self.checkpoint()
+
+                await self.wait(interval)
+            except Exception as e:
+                self.failed("poll", e)
+                await self.wait(self.retry_interval)
+
+    # 想定外の例外でもタスクを終了させず、記録して次の周期に進む
+    def failed(self, name, e):
+        metrics.count(f"{name}.error")
+        print(f"Unexpected error in {name}: {e!r}\r\n")
+
+    def valid_action(self, action):
+        command = action.get("command") if isinstance(action, dict) else None
+        if not isinstance(command, str) or not command.strip():
+            metrics.count("action.invalid")
+            print(f"Invalid action: {action}\r\n")
+            return False
+        return True
+
+    async def handle_action(self, action):
+        if not self.valid_action(action):
+            return
+        if action.get("controlId"):
+            # コマンドを送信する
+            if await self.plcs.send_command(self.plcs.resolve(action), action.get("command")) is None:
+                print("Failed to send command to KV8000\r\n")
+        if action.get("sensorId"):
+            self.sensors[action.get("sensorId")] = action
+            self.scheduler.request(action)
+            # 再起動後は回線の準備を待たずにサンプリングを再開できるように保存する
+            self.state.set("sensors", list(self.sensors.values()))
+
+    # 期限が来たレジスタだけを重複なく、PLCごとに並列に読み出す
+    async def read_registers(self, keys, now):
+        values = {}
+        groups = {}
+        for key in keys:
+            value = self.scheduler.cached(key, now)
+            if value is not None:
+                values[key] = value
+            else:
+                groups.setdefault(key[0], []).append(key[1])
+        if groups:
+            with metrics.timer("cycle.plc_read"):
+                read = await self.plcs.read_all(groups)
+            # キャッシュから返した値は保存し直さない (期限が延びて古い値を返し続けるため)
+            for key, value in read.items():
+                self.scheduler.store(key, value, now)
+            values.update(read)
+        self.scheduler.mark(keys, now)
+        return values
+
+    async def sample_sensors(self):
+        now = time.monotonic()
+        values = await self.read_registers(self.scheduler.due(self.sensors, now), now)
+
+        rows = []
+        for sensor_id, action in self.sensors.items():
+            key = self.scheduler.key(action)
+            if key not in values:
+                continue
+            print("Value:", values[key])
+            value = values[key]
+            if self.filter:
+                # 変化が小さい値は送信しない
+                value = self.filter.process(sensor_id, key[1], value, now)
+                if value is None:
+                    metrics.count("filter.suppressed")
+                    continue
+            rows.append({
+                "sensorId": sensor_id,
+                "value": value,
+                "plantId": action.get("plantId"),
+                "count": action.get("count")
+            })
+
+        # 送信前に必ずローカルのキューに保存する
+        with metrics.timer("cycle.queue"):
+            queued = self.queue.extend(rows)
+        metrics.count("measure.sampled", len(rows))
+        if queued:
+            self.pending.set()
+
+    # 上り通信の速度に関係なく、レジスタごとの周期でPLCをサンプリングする
+    async def sample(self):
+        while not self.stopping.is_set():
+            try:
+                next_sample = self.scheduler.next_time(self.sensors)
+                timeout = max(next_sample - time.monotonic(), 0) if next_sample is not None else self.sampling_interval
+                try:
+                    await self.handle_action(await asyncio.wait_for(self.actions.get(), timeout))
+                    while not self.actions.empty():
+                        await self.handle_action(self.actions.get_nowait())
+                except asyncio.TimeoutError:
+                    pass
+
+                next_sample = self.scheduler.next_time(self.sensors)
+                if next_sample is not None and time.monotonic() >= next_sample:
+                    with metrics.timer("cycle.sample"):
+                        await self.sample_sensors()
+                        self.checkpoint()
+                    if self.started_at is not None:
+                        metrics.observe("runtime.first_sample", time.monotonic() - self.started_at)
+                        self.started_at = None
+            except Exception as e:
+                self.failed("sample", e)
+                await self.wait(self.retry_interval)
+
+    # キューから送信済みのオフセット以降を読み出してまとめて送信する
+    async def flush(self):
+        entries = self.queue.peek(self.batch.max_size)
+        if not entries:
+            return True
+        self.batch.clear()
+        for id, row, created_at in entries:
+            self.batch.add(row, created_at)
+        if not self.batch.should_flush():
+            return True
+
+        with metrics.timer("cycle.upload"):
+            result = await self.modem.call(self.batch.flush, self.modem.session.post)
+        sent = len(entries) - len(self.batch.rows)
+        if sent:
+            self.queue.ack(entries[sent - 1][0])
+            metrics.count("measure.uploaded", sent)
+            # サンプリングから送信完了までの時間
+            now = time.time()
+            for id, row, created_at in entries[:sent]:
+                metrics.observe("measure.latency", now - created_at)
+        return result
+
+    async def upload(self):
+        delay = self.retry_interval
+        while not self.stopping.is_set():
+            try:
+                try:
+                    await asyncio.wait_for(self.pending.wait(), self.polling_interval)
+                except asyncio.TimeoutError:
+                    pass
+                if self.stopping.is_set():
+                    break
+                self.pending.clear()
+
+                if await self.flush():
+                    delay = self.retry_interval
+                    if self.queue.size() >= self.batch.max_size:
+                        self.pending.set()
+                else:
+                    metrics.count("upload.retry")
+                    if await self.recover():
+                        delay = self.retry_interval
+                    print(f"Failed to insert measure table (retry in {delay}s)\r\n")
+                    await self.wait(delay)
+                    delay = min(delay * 2, self.max_retry_interval)
+                    self.pending.set()
+            except Exception as e:
+                self.failed("upload", e)
+                await self.wait(self.retry_interval)
+
+    # 定期的に要約を出力し、ファイルに書き出す
+    async def report_metrics(self):
+        while not self.stopping.is_set():
+            await self.wait(self.metrics_interval)
+            self.write_metrics()
+
+    def write_metrics(self):
+        print(metrics.summary())
+        print(f"[plc] {self.plcs.health()}")
+        if self.metrics_path:
+            try:
+                metrics.write(self.metrics_path)
+            except OSError as e:
+                print(f"Failed to write metrics: {e}")
+
+    async def run(self):
+        self.actions = asyncio.Queue(maxsize=self.queue_size)
+        self.pending = asyncio.Event()
+        self.stopping = asyncio.Event()
+
+        self.started_at = time.monotonic()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, self.stop)
+
+        for action in self.state.get("sensors", []):
+            if not self.valid_action(action):
+                continue
+            self.sensors[action.get("sensorId")] = action
+            self.scheduler.request(action)
+
+        # サンプリングはモデムの起動と並行して始める
+        uplink = asyncio.create_task(self.uplink())
+        tasks = [
+            asyncio.create_task(self.sample()),
+            asyncio.create_task(self.report_metrics())
+        ]
+        await self.stopping.wait()
+        # 上り通信はモデムのスレッドで実行中の送信を取り消せないため、終わって抜けるのを待つ
+        # (その間もactionを受け取れるようにサンプリングは後で止める)
+        self.pending.set()
+        await asyncio.gather(uplink, return_exceptions=True)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+        # 送信できなかったデータはキューに残り、次回起動時に送信する
+        await self.flush()
+
+        self.checkpoint()
+        self.write_metrics()
+        await self.update_device(False)
+        await self.plcs.disconnect()
+        await self.modem.close()
+        self.queue.close()
@@ -0,0 +1,70 @@
+class SamplingScheduler:
+    def __init__(self, cmd_map, periods={}, default_period=20, ttl=1, registry=None):
+        self.registry = registry
+        self.commands = {command: name for name, command in cmd_map.items()}
+        self.periods = periods
+        self.default_period = default_period
+        self.ttl = ttl
+        self.next_due = {}
+        self.cache = {}
+        self.hits = 0
+        self.skipped = set()
+
+    # cmd_mapにあるコマンドはレジスタ名に、それ以外はコマンドのままにして(PLC名, レジスタ)をキーにする
+    def key(self, action):
+        plc = self.registry.resolve(action) if self.registry else None
+        return plc, self.register(action.get("command"))
+
+    # commandが無い場合はNoneを返す
+    def register(self, command):
+        if not isinstance(command, str) or not command.strip():
+            return None
+        command = command.strip()
+        parts = command.split()
+        if len(parts) == 3 and parts[2] == "1":
+            command = " ".join(parts[:2])
+        return self.commands.get(command, command)
+
+    def period(self, key):
+        return self.periods.get(key[1], self.default_period)
+
+    # 読み出せないactionは1回だけ記録して飛ばす
+    def keys(self, sensors):
+        keys = set()
+        for sensor_id, action in sensors.items():
+            key = self.key(action)
+            if key[1] is None:
+                if sensor_id not in self.skipped:
+                    print(f"Skipping sensor without command: {sensor_id}\r\n")
+                    self.skipped.add(sensor_id)
+                continue
+            keys.add(key)
+        return keys
+
+    # 期限が来たレジスタを重複なく返す
+    def due(self, sensors, now):
+        return [key for key in self.keys(sensors) if self.next_due.get(key, 0) <= now]
+
+    def next_time(self, sensors):
+        return min((self.next_due.get(key, 0) for key in self.keys(sensors)), default=None)
+
+    def cached(self, key, now):
+        entry = self.cache.get(key)
+        if entry and now - entry[1] <= self.ttl:
+            self.hits += 1
+            return entry[0]
+        return None
+
+    def store(self, key, value, now):
+        self.cache[key] = (value, now)
+
+    # 新しく追加されたセンサーはすぐに読み出す (TTL内ならキャッシュを返す)
+    def request(self, action):
+        key = self.key(action)
+        if key[1] is not None:
+            self.next_due[key] = 0
+
+    # 読み出しに失敗したレジスタも次の周期まで待つ
+    def mark(self, keys, now):
+        for key in keys:
+            self.next_due[key] = now + self.period(key)
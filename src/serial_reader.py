@@ -0,0 +1,154 @@
+import re
+import time
+import threading
+
+from src.metrics import metrics
+
+# UARTを専用スレッドで読み続け、コマンドの応答は待っている呼び出し元に、URCはhandlersに渡す
+class SerialReader:
+    # URCの名前と、その行を応答として受け取るコマンド (それ以外は"AT" + 名前のコマンド)
+    owners = {
+        "+APP PDP": "AT+CNACT"
+    }
+
+    def __init__(self, modem, prefixes=(), size=65536, backoff=0.5, max_backoff=10):
+        self.modem = modem
+        self.prefixes = tuple(prefixes)
+        self.size = size
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.errors = 0
+        self.buffer = bytearray()
+        self.response = bytearray()
+        self.command = None
+        self.payload = 0
+        self.handlers = []
+        self.pending = 0
+        self.condition = threading.Condition()
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread and self.thread is not threading.current_thread():
+            self.thread.join()
+
+    # 読み出しに失敗してもスレッドは終了せず、ポートを開き直して読み続ける
+    def run(self):
+        delay = self.backoff
+        while self.running:
+            try:
+                data = self.modem.read(self.modem.inWaiting() or 1)
+            except Exception as e:
+                self.errors += 1
+                metrics.count("modem.read_error")
+                print(f"Failed to read from SIM7080G: {e}\r\n")
+                time.sleep(delay)
+                delay = min(delay * 2, self.max_backoff)
+                self.reopen()
+                continue
+            delay = self.backoff
+            if data:
+                self.feed(data)
+
+    def reopen(self):
+        if not hasattr(self.modem, "open"):
+            return
+        try:
+            self.modem.close()
+            self.modem.open()
+            metrics.count("modem.reopen")
+        except Exception as e:
+            print(f"Failed to reopen SIM7080G: {e}\r\n")
+
+    # 古いデータから捨てて、未処理のデータをsize以下に保つ
+    # handlersはロックの外で呼ぶが、終わるまでは待っている呼び出し元を起こさない
+    def feed(self, data):
+        urcs = []
+        with self.condition:
+            self.buffer += data
+            if len(self.buffer) > self.size:
+                metrics.count("modem.overflow", len(self.buffer) - self.size)
+                del self.buffer[:len(self.buffer) - self.size]
+            self.split(urcs)
+            self.pending += len(urcs)
+        try:
+            for line in urcs:
+                self.dispatch(line)
+        finally:
+            with self.condition:
+                self.pending -= len(urcs)
+                self.condition.notify_all()
+
+    # handlerの例外で読み出しのスレッドを止めない
+    def dispatch(self, line):
+        for handler in self.handlers:
+            try:
+                handler(line)
+            except Exception as e:
+                metrics.count("modem.handler_error")
+                print(f"Failed to handle {line}: {e}\r\n")
+
+    def split(self, urcs):
+        while self.buffer:
+            # AT+SHREADのデータは改行を含むことがあるため、指定された長さをそのまま応答に入れる
+            if self.payload:
+                data = self.buffer[:self.payload]
+                del self.buffer[:len(data)]
+                self.payload -= len(data)
+                self.response += data
+                continue
+
+            end = self.buffer.find(b'\r\n')
+            if end == -1:
+                # AT+SHBODの'>'は改行なしで届く
+                if self.command and self.buffer.lstrip().startswith(b'>'):
+                    self.response += self.buffer
+                    del self.buffer[:]
+                return
+            line = bytes(self.buffer[:end + 2])
+            del self.buffer[:end + 2]
+            self.route(line, urcs)
+
+    def route(self, line, urcs):
+        text = line.decode(errors='ignore').strip()
+        if text.startswith(self.prefixes):
+            urcs.append(text)
+            if not self.owns(text):
+                return
+        if self.command is None:
+            if text:
+                metrics.count("modem.unexpected")
+            return
+        self.response += line
+        match = re.match(r'\+SHREAD: *(\d+)', text)
+        if match:
+            self.payload = int(match.group(1))
+
+    def owns(self, text):
+        if self.command is None:
+            return False
+        name = text.split(":", 1)[0]
+        return re.split(r'[=?]', self.command, 1)[0] == self.owners.get(name, f"AT{name}")
+
+    # 送信前に呼び、それ以降に届いた応答だけを受け取る
+    def begin(self, command):
+        with self.condition:
+            self.command = command
+            self.response = bytearray()
+            self.payload = 0
+
+    # completeがTrueを返し、届いた行のhandlersが終わるか、timeoutまで待って応答を返す
+    def wait(self, complete, timeout):
+        with self.condition:
+            self.condition.wait_for(lambda: not self.pending and complete(bytes(self.response)), timeout)
+            response = bytes(self.response)
+            self.command = None
+            self.response = bytearray()
+            self.payload = 0
+            return response
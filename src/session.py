@@ -0,0 +1,100 @@
+from src.metrics import metrics
+
+class HTTPSSession:
+    def __init__(self, sim7080g, url, headers={}, bodylen=4096, headerlen=350, ssl=True):
+        self.sim7080g = sim7080g
+        self.url = url
+        self.headers = headers
+        self.bodylen = bodylen
+        self.headerlen = headerlen
+        self.ssl = ssl
+        self.applied = {}
+        self.connected = False
+        self.connect_count = 0
+
+    # 適用済みの設定は再送しない
+    def apply(self, key, command):
+        if self.applied.get(key) == command:
+            return 1
+        if self.sim7080g.send_at_command(command, 'OK'):
+            self.applied[key] = command
+            return 1
+        return 0
+
+    def configure(self):
+        if self.ssl:
+            self.apply("ignorertctime", 'AT+CSSLCFG="ignorertctime",1,1')
+            self.apply("sslversion", 'AT+CSSLCFG="sslversion",1,3')
+            self.apply("ssl", 'AT+SHSSL=1,""')
+        self.apply("url", f'AT+SHCONF="URL","{self.url}"')
+        self.apply("bodylen", f'AT+SHCONF="BODYLEN",{self.bodylen}')
+        self.apply("headerlen", f'AT+SHCONF="HEADERLEN",{self.headerlen}')
+
+    def set_headers(self):
+        for key, value in self.headers.items():
+            self.apply(f"header:{key}", f'AT+SHAHEAD="{key}","{value}"')
+
+    def is_connected(self):
+        return self.sim7080g.send_at_command('AT+SHSTATE?', '+SHSTATE: 1')
+
+    def connect(self):
+        self.configure()
+        if not self.sim7080g.send_at_command('AT+SHCONN', 'OK', 5):
+            # 設定が失われている可能性があるため次回は全て再送する
+            self.applied = {}
+            self.connected = False
+            metrics.count("https.connect_error")
+            print("HTTPS session connection failed\r\n")
+            return 0
+        self.connect_count += 1
+        metrics.count("https.connect")
+        self.applied = {key: value for key, value in self.applied.items() if not key.startswith("header:")}
+        self.sim7080g.send_at_command('AT+SHCHEAD', 'OK')
+        self.set_headers()
+        self.connected = True
+        return 1
+
+    def ensure(self):
+        if self.connected and self.is_connected():
+            return 1
+        self.connected = False
+        return self.connect()
+
+    def request(self, method, body=None, name="HTTPS POST", stream=False):
+        if stream:
+            failed = {
+                "code": None,
+                "length": 0,
+                "chunks": iter(())
+            }
+        else:
+            failed = {
+                "code": None,
+                "data": None
+            }
+        if body and len(body) > self.bodylen:
+            print(f"Body exceeds BODYLEN ({len(body)} > {self.bodylen})\r\n")
+            return failed
+        if not self.ensure():
+            return failed
+        send_request = self.sim7080g.send_request_stream if stream else self.sim7080g.send_request
+        response = send_request(self.url, method, body, name=name)
+        if response.get("code") is None:
+            metrics.count("https.error")
+            self.connected = False
+        return response
+
+    def get(self):
+        return self.request(1, name="HTTPS GET")
+
+    def post(self, body):
+        return self.request(3, body, name="HTTPS POST")
+
+    # レスポンスのボディはchunksから順に読み出す
+    def post_stream(self, body):
+        return self.request(3, body, name="HTTPS POST", stream=True)
+
+    def close(self):
+        if self.connected:
+            self.sim7080g.close()
+        self.connected = False
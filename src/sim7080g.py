@@ -1,70 +1,130 @@
+import re
+import codecs
 import serial
 import time
 
+from src.metrics import metrics
+from src.serial_reader import SerialReader
+
 class SIM7080G:
-    def __init__(self, port='/dev/ttyAMA0', baudrate=115200, debug=False):
+    final_codes = ("OK", "ERROR")
+    error_codes = ("ERROR", "+CME ERROR")
+    read_chunk_size = 1024
+    # 優先する通信方式 (CNMP=38: LTEのみ, CMNB=1: CAT-M)
+    network = {"CNMP": "38", "CMNB": "1"}
+    # URCと回線の状態を表す行はhandlersに渡し、送信中のコマンドへの応答でなければ応答には含めない
+    status_prefixes = ("+APP PDP:", "+SHSTATE:", "+SHREQ:", "+CGATT:", "+CNACT:", "+CSQ:", "+CPSI:", "+CEREG:", "+CPIN:")
+
+    def __init__(self, port='/dev/ttyAMA0', baudrate=115200, debug=False, modem=None):
         self.time = time
         self.port = port
         self.baudrate = baudrate
-        self.modem = serial.Serial(self.port, self.baudrate)
+        self.modem = modem if modem else serial.Serial(self.port, self.baudrate, timeout=0.01)
         self.modem.flushInput()
         self.debug = debug
+        self.reader = SerialReader(self.modem, self.status_prefixes)
+        self.reader.start()
+
+    # handlerはSerialReaderのスレッドから呼ばれる
+    def add_handler(self, handler):
+        self.reader.handlers.append(handler)
+
+    def stop(self):
+        self.reader.stop()
 
     def set_apn(self, apn, username="", password=""):
         self.apn = apn
         self.username = username
         self.password = password
 
-    def send_at_command(self, command, back, timeout=1.0):
-        buffer = ''
-        self.modem.write((command + '\r\n').encode())
-        self.time.sleep(timeout)
-        if self.modem.inWaiting():
-            self.time.sleep(0.1)
-            buffer = self.modem.read(self.modem.inWaiting())
-        if buffer != '':
-            if back not in buffer.decode():
+    # AT+SHBOD後のボディなどATコマンド以外はDATAとして集計する
+    def command_name(self, command):
+        if not command.startswith("AT"):
+            return "DATA"
+        return re.split(r'[=?]', command, 1)[0]
+
+    def transact(self, command, back, timeout=1.0, urc=False, payload=0):
+        name = self.command_name(command)
+        data = (command + '\r\n').encode()
+        start = self.time.perf_counter()
+        self.reader.begin(command)
+        self.modem.write(data)
+        buffer = self.read_response(command, back, timeout, urc, payload)
+        metrics.observe(f"at.{name}", self.time.perf_counter() - start)
+        metrics.count("modem.tx_bytes", len(data))
+        metrics.count("modem.rx_bytes", len(buffer))
+        if not buffer:
+            metrics.count("at.timeout")
+        elif back not in self.strip_echo(command, buffer):
+            metrics.count("at.error")
+        return buffer
+
+    def send_at_command(self, command, back, timeout=1.0, urc=False):
+        buffer = self.transact(command, back, timeout, urc)
+        if buffer:
+            if back not in self.strip_echo(command, buffer):
                 print(command + ' ERROR')
-                print(command + ' back:\t' + buffer.decode())
+                print(command + ' back:\t' + buffer.decode(errors='ignore'))
                 return 0
             else:
                 if self.debug:
-                    print(buffer.decode())
+                    print(buffer.decode(errors='ignore'))
                 return 1
         else:
             print(command + ' no response')
             return 0
 
-    def send_at_command_and_wait_response(self, command, back, timeout=1.0):
-        buffer = b''
-        self.modem.write((command + '\r\n').encode())
-        self.time.sleep(timeout)
-        if self.modem.inWaiting():
-            self.time.sleep(0.1)
-            buffer = self.modem.read(self.modem.inWaiting())
-        if buffer != '':
-            if back not in buffer.decode():
+    def send_at_command_and_wait_response(self, command, back, timeout=1.0, urc=False, payload=0):
+        buffer = self.transact(command, back, timeout, urc, payload)
+        if buffer:
+            if back not in self.strip_echo(command, buffer):
                 if self.debug:
                     print(command + ' ERROR')
-                    print(command + ' back:\t' + buffer.decode())
-                return buffer
+                    print(command + ' back:\t' + buffer.decode(errors='ignore'))
             else:
                 if self.debug:
-                    print(buffer.decode())
-                return buffer
+                    print(buffer.decode(errors='ignore'))
         else:
             print(command + ' no response')
         return buffer
-    
+
+    # timeoutは上限であり、最終リザルトコードを受信した時点で返す
+    def read_response(self, command, back, timeout=1.0, urc=False, payload=0):
+        return self.reader.wait(lambda buffer: self.is_complete(command, buffer, back, urc, payload), timeout)
+
+    def strip_echo(self, command, buffer):
+        text = buffer.decode(errors='ignore')
+        start = text.find(command)
+        if start != -1 and not text[:start].strip():
+            return text[start + len(command):]
+        return text
+
+    def is_complete(self, command, buffer, back, urc=False, payload=0):
+        text = self.strip_echo(command, buffer)
+        lines = [line.strip() for line in text.split('\r\n')[:-1]]
+        for line in lines:
+            if any(line.startswith(code) for code in self.error_codes):
+                return True
+        if back == '>':
+            return '>' in text
+        if not urc:
+            return any(line in self.final_codes for line in lines)
+        index = text.find(back)
+        if index == -1:
+            return False
+        end = text.find('\r\n', index)
+        if end == -1:
+            return False
+        return len(text.encode()) - len(text[:end + 2].encode()) >= payload
+
     def set_debug_level(self, level=2):
         if level not in [0, 1, 2]:
             print("Invalid level.")
             return False
         return self.send_at_command(f"AT+CMEE={level}", "OK")
 
+    # 既に応答する場合は待たずに返す
     def init(self, retry=5):
-        self.send_at_command("AT", "OK")
-        self.time.sleep(1)
         for i in range(retry):
             if self.send_at_command("AT", "OK") == 1:
                 print('SIM7080G is ready\r\n')
@@ -73,39 +133,59 @@ class SIM7080G:
                 return 1
             else:
                 print('SIM7080G is not ready\r\n')
-                self.time.sleep(5)
+                self.time.sleep(1 if i == 0 else 5)
         return 0
 
+    # 問い合わせの応答からpatternの最初のグループを返す
+    def query(self, command, pattern):
+        buffer = self.send_at_command_and_wait_response(command, 'OK')
+        match = re.search(pattern, self.strip_echo(command, buffer))
+        return match.group(1) if match else None
+
+    def network_settings(self):
+        return {
+            "CNMP": self.query("AT+CNMP?", r'\+CNMP: *(\d+)'),
+            "CMNB": self.query("AT+CMNB?", r'\+CMNB: *(\d+)')
+        }
+
     def set_network(self):
         self.send_at_command("AT+CFUN=0", "OK")
-        self.send_at_command("AT+CNMP=38", "OK")
-        self.send_at_command("AT+CMNB=1", "OK")
+        self.send_at_command(f"AT+CNMP={self.network['CNMP']}", "OK")
+        self.send_at_command(f"AT+CMNB={self.network['CMNB']}", "OK")
         self.send_at_command("AT+CFUN=1", "OK")
 
+    def set_pdp(self):
+        if self.username:
+            return self.send_at_command(f'AT+CNCFG=0,1,"{self.apn}","{self.username}","{self.password}"', "OK")
+        return self.send_at_command(f'AT+CNCFG=0,1,"{self.apn}"', "OK")
+
     def check_network(self):
         if self.send_at_command("AT+CPIN?", "READY") != 1:
             print("SIM7080G is not ready\r\n")
-        for i in range(1, 10):
-            if self.send_at_command("AT+CGATT?", "1"):
-                print('SIM7080G is online\r\n')
-                break
-            else:
-                print('SIM7080G is offline\r\n')
-                self.time.sleep(5)
-                continue
+        self.wait_attached()
         self.send_at_command("AT+CSQ", "OK")
         self.send_at_command("AT+CPSI?", "OK")
         self.send_at_command("AT+COPS?", "OK")
-        if self.username:
-            self.send_at_command(f'AT+CNCFG=0,1,"{self.apn}","{self.username}","{self.password}"', "OK")
-        else:
-            self.send_at_command(f'AT+CNCFG=0,1,"{self.apn}"', "OK")
-        if self.send_at_command('AT+CNACT=0,1', 'ACTIVE'):
+        self.set_pdp()
+        if self.send_at_command('AT+CNACT=0,1', '+APP PDP: 0,ACTIVE', 3, urc=True):
             print("Network is ready\r\n")
         else:
             print("Network is not ready\r\n")
         self.send_at_command('AT+CNACT?', 'OK')
     
+    # アタッチされるまでAT+CGATT?を短い間隔から問い合わせる
+    def wait_attached(self, timeout=45, interval=0.5, max_interval=5):
+        deadline = self.time.monotonic() + timeout
+        while True:
+            if self.send_at_command("AT+CGATT?", "+CGATT: 1"):
+                print('SIM7080G is online\r\n')
+                return 1
+            print('SIM7080G is offline\r\n')
+            if self.time.monotonic() + interval > deadline:
+                return 0
+            self.time.sleep(interval)
+            interval = min(interval * 2, max_interval)
+
     def set_http_headers(self, headers):
         for key, value in headers.items():
             self.send_at_command(f'AT+SHAHEAD="{key}","{value}"', 'OK')
@@ -121,6 +201,91 @@ class SIM7080G:
     def close(self):
         self.send_at_command('AT+SHDISC', 'OK')
 
+    def read_body(self, length, offset=0):
+        buffer = self.send_at_command_and_wait_response(f'AT+SHREAD={offset},{length}', '+SHREAD:', 5, urc=True, payload=length)
+        index = buffer.find(b'+SHREAD:')
+        if index == -1:
+            return None
+        start = buffer.find(b'\r\n', index) + 2
+        data = buffer[start:start + length]
+        return data if len(data) == length else None
+
+    # 受信したレスポンスをAT+SHREADで分割して読み出す (途中で読み出せなければConnectionError)
+    def read_chunks(self, length, chunk_size=None):
+        chunk_size = chunk_size if chunk_size else self.read_chunk_size
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="ignore")
+        for offset in range(0, length, chunk_size):
+            data = self.read_body(min(chunk_size, length - offset), offset)
+            if data is None:
+                raise ConnectionError(f"Failed to read response at {offset}/{length}")
+            yield decoder.decode(data)
+        yield decoder.decode(b'', final=True)
+
+    def parse_shreq(self, buffer):
+        match = re.search(r'\+SHREQ: *"?(\w+)"?,(\d+),(\d+)', buffer.decode(errors='ignore'))
+        if not match:
+            return None
+        return match.group(1), int(match.group(2)), int(match.group(3))
+
+    # SHCONN済みのコネクションでリクエストを送信し、ボディはchunksから順に読み出す (method: 1=GET, 3=POST)
+    # ボディを送れなかった場合はAT+SHREQを送らない (空や前回のボディで送信されるため)
+    def send_request_stream(self, url, method, body=None, name="HTTPS POST"):
+        failed = {
+            "code": None,
+            "length": 0,
+            "chunks": iter(())
+        }
+        if body:
+            bodylen = len(body)
+            if not self.send_at_command(f'AT+SHBOD={bodylen},10000', '>') or not self.send_at_command(body, 'OK', 1):
+                print(f"Failed to send body in {name}\r\n")
+                metrics.count("http.body_error")
+                return failed
+        result = self.parse_shreq(self.send_at_command_and_wait_response(f'AT+SHREQ="{url}",{method}', '+SHREQ:', 8, urc=True))
+        if not result:
+            print(f"ValueError in {name}\r\n")
+            return failed
+        _, status_code, length = result
+        metrics.count("http.tx_bytes", len(body) if body else 0)
+        metrics.count("http.rx_bytes", length)
+        print(f"Code: {status_code}")
+        return {
+            "code": status_code,
+            "length": length,
+            "chunks": self.read_chunks(length)
+        }
+
+    def send_request(self, url, method, body=None, name="HTTPS POST"):
+        response = self.send_request_stream(url, method, body, name)
+        if response.get("code") is None:
+            return {
+                "code": None,
+                "data": None
+            }
+        if response.get("length") > 0:
+            try:
+                response_data = "".join(response.get("chunks"))
+            except ConnectionError as e:
+                print(f"{e}\r\n")
+                response_data = ""
+            if len(response_data.encode()) < response.get("length"):
+                print(f"Incomplete response in {name}\r\n")
+                return {
+                    "code": None,
+                    "data": None
+                }
+            print("Response: ", response_data)
+            return {
+                "code": response.get("code"),
+                "data": response_data
+            }
+        else:
+            print("No response received\r\n")
+            return {
+                "code": response.get("code"),
+                "data": None
+            }
+
     def http_get(self, url, headers={}):
         self.send_at_command(f'AT+SHCONF="URL","{url}"', 'OK')
         self.set_http_length()
@@ -128,31 +293,7 @@ class SIM7080G:
         if headers:
             self.set_http_headers(headers)
         if self.send_at_command('AT+SHSTATE?', '1'):
-            response = str(self.send_at_command_and_wait_response(f'AT+SHREQ="{url}",1', 'OK', 8))
-            try:
-                status_code = int(response[response.rfind(',') - 3:response.rfind(',')])
-                print(f"Code: {status_code}")
-
-                packet_length = int(response[response.rfind(',') + 1:-5])
-                if packet_length > 0:
-                    response_data = self.send_at_command_and_wait_response(f'AT+SHREAD=0,{packet_length}', 'OK', 5).decode()
-                    print("Response: ", response_data)
-                    return {
-                        "code": 200,
-                        "data": response_data
-                    }
-                else:
-                    print("No response received\r\n")
-                    return {
-                        "code": None,
-                        "data": None
-                    }
-            except ValueError:
-                print("ValueError in HTTP GET\r\n")
-                return {
-                    "code": None,
-                    "data": None
-                }
+            return self.send_request(url, 1, name="HTTP GET")
         else:
             print("HTTP connection disconnected\r\n")
             return {
@@ -169,33 +310,7 @@ class SIM7080G:
         if headers:
             self.set_http_headers(headers)
         if self.send_at_command('AT+SHSTATE?', '1'):
-            if body and self.send_at_command(f'AT+SHBOD={bodylen},10000', '>'):
-                self.send_at_command(body, 'OK', 1)
-            response = str(self.send_at_command_and_wait_response(f'AT+SHREQ="{url}",3', 'OK', 8))
-            try:
-                status_code = int(response[response.rfind(',') - 3:response.rfind(',')])
-                print(f"Code: {status_code}")
-
-                packet_length = int(response[response.rfind(',') + 1:-5])
-                if packet_length > 0:
-                    response_data = self.send_at_command_and_wait_response(f'AT+SHREAD=0,{packet_length}', 'OK', 5).decode()
-                    print("Response: ", response_data)
-                    return {
-                        "code": status_code,
-                        "data": response_data
-                    }
-                else:
-                    print("No response received\r\n")
-                    return {
-                        "code": status_code,
-                        "data": None
-                    }
-            except ValueError:
-                print("ValueError in HTTP POST\r\n")
-                return {
-                    "code": None,
-                    "data": None
-                }
+            return self.send_request(url, 3, body, name="HTTP POST")
         else:
             print("HTTP connection disconnected\r\n")
             return {
@@ -203,43 +318,21 @@ class SIM7080G:
                 "data": None
             }
 
-
-    def https_get(self, url, headers={}):
-        print("HTTPS GET")
+    def set_https(self):
         self.send_at_command('AT+CSSLCFG="ignorertctime",1,1', 'OK')
         self.send_at_command('AT+CSSLCFG="sslversion",1,3', 'OK')
         self.send_at_command('AT+SHSSL=1,""', 'OK')
+
+    def https_get(self, url, headers={}):
+        print("HTTPS GET")
+        self.set_https()
         self.send_at_command(f'AT+SHCONF="URL","{url}"', 'OK')
         self.set_http_length()
         self.send_at_command('AT+SHCONN', 'OK', 5)
         if headers:
             self.set_http_headers(headers)
         if self.send_at_command('AT+SHSTATE?', '1'):
-            response = str(self.send_at_command_and_wait_response(f'AT+SHREQ="{url}",1', 'OK', 8))
-            try:
-                status_code = int(response[response.rfind(',') - 3:response.rfind(',')])
-                print(f"Code: {status_code}")
-
-                packet_length = int(response[response.rfind(',') + 1:-5])
-                if packet_length > 0:
-                    response_data = self.send_at_command_and_wait_response(f'AT+SHREAD=0,{packet_length}', 'OK', 5).decode()
-                    print("Response: ", response_data)
-                    return {
-                        "code": 200,
-                        "data": response_data
-                    }
-                else:
-                    print("No response received\r\n")
-                    return {
-                        "code": None,
-                        "data": None
-                    }
-            except ValueError:
-                print("ValueError in HTTPS GET\r\n")
-                return {
-                    "code": None,
-                    "data": None
-                }
+            return self.send_request(url, 1, name="HTTPS GET")
         else:
             print("HTTPS connection disconnected\r\n")
             return {
@@ -249,9 +342,7 @@ class SIM7080G:
 
     def https_post(self, url, headers={}, body=None):
         print("HTTPS POST")
-        self.send_at_command('AT+CSSLCFG="ignorertctime",1,1', 'OK')
-        self.send_at_command('AT+CSSLCFG="sslversion",1,3', 'OK')
-        self.send_at_command('AT+SHSSL=1,""', 'OK')
+        self.set_https()
         self.send_at_command(f'AT+SHCONF="URL","{url}"', 'OK')
         bodylen = len(body) if body else 0
         self.set_http_length(bodylen)
@@ -259,33 +350,7 @@ class SIM7080G:
         if headers:
             self.set_http_headers(headers)
         if self.send_at_command('AT+SHSTATE?', '1'):
-            if body and self.send_at_command(f'AT+SHBOD={bodylen},10000', '>'):
-                self.send_at_command(body, 'OK', 1)
-            response = str(self.send_at_command_and_wait_response(f'AT+SHREQ="{url}",3', 'OK', 8))
-            try:
-                status_code = int(response[response.rfind(',') - 3:response.rfind(',')])
-                print(f"Code: {status_code}")
-
-                packet_length = int(response[response.rfind(',') + 1:-5])
-                if packet_length > 0:
-                    response_data = self.send_at_command_and_wait_response(f'AT+SHREAD=0,{packet_length}', 'OK', 5).decode()
-                    print("Response: ", response_data)
-                    return {
-                        "code": status_code,
-                        "data": response_data
-                    }
-                else:
-                    print("No response received\r\n")
-                    return {
-                        "code": status_code,
-                        "data": None
-                    }
-            except ValueError:
-                print("ValueError in HTTPS POST\r\n")
-                return {
-                    "code": None,
-                    "data": None
-                }
+            return self.send_request(url, 3, body, name="HTTPS POST")
         else:
             print("HTTPS connection disconnected\r\n")
             return {
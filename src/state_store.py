@@ -0,0 +1,71 @@
+import os
+import json
+
+class StateStore:
+    version = 1
+
+    def __init__(self, path, legacy_count_path=None):
+        self.path = path
+        self.legacy_count_path = legacy_count_path
+        self.state = {
+            "count": None,
+            "upload_offset": 0
+        }
+        self.dirty = False
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path, "r") as f:
+                data = json.load(f)
+            if not isinstance(data, dict) or not isinstance(data.get("state", {}), dict):
+                raise ValueError("state is not an object")
+            if data.get("version", 0) > self.version:
+                print(f"Unknown state version: {data.get('version')}\r\n")
+                return
+            self.state.update(data.get("state", {}))
+        except FileNotFoundError:
+            self.migrate()
+        except (ValueError, TypeError, OSError) as e:
+            # 破損している場合は初期値で起動する
+            print(f"Failed to load state: {e}")
+
+    # storage/count.txtから移行する
+    # 旧形式はcount=eq.Nで実行中のcountを持ち、新形式は取得済みのcountより大きい行を取得するためN-1にする
+    def migrate(self):
+        if not self.legacy_count_path or not os.path.exists(self.legacy_count_path):
+            return
+        try:
+            with open(self.legacy_count_path, "r") as f:
+                self.state["count"] = int(f.read()) - 1
+            self.dirty = True
+        except ValueError:
+            print("Invalid count file\r\n")
+
+    def get(self, key, default=None):
+        return self.state.get(key, default)
+
+    def set(self, key, value):
+        if self.state.get(key) != value:
+            self.state[key] = value
+            self.dirty = True
+
+    # 一時ファイルに書き込んでfsyncしてから置き換える
+    def save(self):
+        if not self.dirty:
+            return False
+        directory = os.path.dirname(self.path)
+        os.makedirs(directory, exist_ok=True)
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, "w") as f:
+            json.dump({"version": self.version, "state": self.state}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self.path)
+        fd = os.open(directory, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        self.dirty = False
+        return True